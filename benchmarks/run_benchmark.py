@@ -0,0 +1,132 @@
+
+# Runs meter_data_integration.py end to end on synthetic data, with local stand-ins for arcpy, Naviline and Box
+# (see stand_ins.py), and reports the throughput of every stage it times.
+#
+#   python benchmarks/run_benchmark.py --meters 100000
+#   python benchmarks/run_benchmark.py --meters 1000000 --esri_latency 0.05 -- -t 4
+#
+# Anything after -- is passed to meter_data_integration.py.
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import time
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(benchmark_dir)
+sys.path.insert(0, benchmark_dir)
+import stand_ins
+import synthetic_data
+
+
+def write_config(workspace, server_url, extra_settings):
+    """
+    Writes configs/config.ini for the run, pointing Box and the meters layer at the local server.
+    """
+    os.makedirs(os.path.join(workspace, 'configs'), exist_ok=True)
+    settings = {
+        'NAVILINE_HOST': 'localhost', 'NAVILINE_DB': 'benchmark', 'JDBC_JAR_PATH': 'benchmark.jar',
+        'OUTPUT_DIR': os.path.join(workspace, 'output'), 'BOX_FILE_ID_METER_DATA': '1', 'BOX_API_URL': server_url,
+        'METERS_FEATURE_SERVER': f"{server_url}/meters", 'NAVILINE_EXTRACTOR': 'jaydebeapi'
+    }
+    settings.update(extra_settings)
+    with open(os.path.join(workspace, 'configs', 'config.ini'), 'w') as f:
+        f.write("[Credentials]\n")
+        for key in ['ARCGIS_USER', 'ARCGIS_PASSWORD', 'NAVILINE_USER', 'NAVILINE_PASSWORD', 'BOX_CLIENT_ID', 'BOX_CLIENT_SECRET', 'BOX_ENTERPRISE_ID']:
+            f.write(f"{key} = benchmark\n")
+        f.write(f"\n[Java]\nSCRIPT_JAVA_HOME = {workspace}\n\n[Misc]\n")
+        for key, value in settings.items():
+            f.write(f"{key} = {value}\n")
+
+
+def report(stage_timings_path, report_path, details):
+    """
+    Prints seconds, rows and rows/sec for every timed stage and writes the same, plus details, to report_path.
+    """
+    with open(stage_timings_path, 'r') as f:
+        stage_timings = json.load(f)
+    width = max([28] + [len(timing['stage']) + 2 for timing in stage_timings])
+    print(f"\n{'stage':<{width}}{'seconds':>10}{'rows in':>12}{'rows out':>12}{'rows/sec':>12}{'peak MB':>10}")
+    for timing in stage_timings:
+        rows = max(timing['rows_in'] or 0, timing['rows_out'] or 0)
+        timing['rows_per_second'] = round(rows / timing['seconds']) if timing['seconds'] > 0 and rows else None
+        print(f"{timing['stage']:<{width}}{timing['seconds']:>10.2f}{str(timing['rows_in']):>12}{str(timing['rows_out']):>12}"
+              f"{str(timing['rows_per_second']):>12}{str(timing['peak_rss_mb']):>10}")
+    details['stages'] = stage_timings
+    with open(report_path, 'w') as f:
+        json.dump(details, f, indent=2)
+    print(f"\nReport written to {report_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the meter integration on synthetic data")
+    parser.add_argument("--meters", help="number of meters to generate (10k to 1M is the useful range)", type=int, default=10000)
+    parser.add_argument("--duplicate_rate", type=float, default=0.005)
+    parser.add_argument("--missing_key_rate", type=float, default=0.01)
+    parser.add_argument("--wrong_radio_rate", type=float, default=0.01)
+    parser.add_argument("--drift_rate", type=float, default=0.005)
+    parser.add_argument("--change_rate", type=float, default=0.05)
+    parser.add_argument("--add_rate", type=float, default=0.02)
+    parser.add_argument("--remove_rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--esri_latency", help="seconds each Esri cursor or applyEdits call waits, to mimic the network", type=float, default=0.0)
+    parser.add_argument("--config", help="extra config.ini Misc settings, ex. ESRI_EDIT_WORKERS=8", action='append', default=[])
+    parser.add_argument("--workspace", help="folder to run in (a temporary folder, removed afterwards, if not given)")
+    parser.add_argument("--report", help="where to write the json report", default=os.path.join(benchmark_dir, "benchmark_report.json"))
+    parser.add_argument("pipeline_args", nargs=argparse.REMAINDER, help="arguments for meter_data_integration.py, after --")
+    args = parser.parse_args()
+
+    report_path = os.path.abspath(args.report)
+    workspace = os.path.abspath(args.workspace) if args.workspace else tempfile.mkdtemp(prefix='meter_benchmark_')
+    os.makedirs(workspace, exist_ok=True)
+    shutil.copytree(os.path.join(repo_dir, 'sql'), os.path.join(workspace, 'sql'), dirs_exist_ok=True)
+    database_path = os.path.join(workspace, 'naviline.sqlite')
+    sensus_path = os.path.join(workspace, 'box_sensus_file.csv')
+
+    layer = stand_ins.MetersLayer()
+    server = stand_ins.start_local_server(layer, sensus_path)
+    server_url = f"http://127.0.0.1:{server.server_port}"
+    write_config(workspace, server_url, dict(setting.split('=', 1) for setting in args.config))
+
+    # meter_data_integration reads configs/config.ini and sql/ relative to the working folder when it's imported
+    os.chdir(workspace)
+    query_tables = {}
+    stand_ins.install_stand_ins(layer, database_path, query_tables)
+    sys.path.insert(0, repo_dir)
+    import meter_data_integration
+    query_tables[meter_data_integration.read_sql_query(meter_data_integration.naviline_query_file).strip()] = 'naviline_meters'
+    query_tables[meter_data_integration.read_sql_query(meter_data_integration.naviline_inventory_query_file).strip()] = 'naviline_inventory'
+
+    rates = synthetic_data.SyntheticRates(args.duplicate_rate, args.missing_key_rate, args.wrong_radio_rate, args.drift_rate,
+                                          args.change_rate, args.add_rate, args.remove_rate)
+    start = time.perf_counter()
+    counts = synthetic_data.generate(args.meters, rates, database_path, sensus_path, layer, list(meter_data_integration.naviline_schema),
+                                     list(meter_data_integration.nv_inventory_schema), meter_data_integration.sensus_file_header, args.seed)
+    print(f"Generated {counts} in {time.perf_counter() - start:.1f} seconds")
+    layer.latency = args.esri_latency
+
+    workdir = os.path.join(workspace, 'output', 'benchmark') + '/'
+    pipeline_args = [arg for arg in args.pipeline_args if arg != '--']
+    sys.argv = ['meter_data_integration.py', '-f', workdir] + pipeline_args
+    start = time.perf_counter()
+    meter_data_integration.main()
+    total_seconds = time.perf_counter() - start
+    server.shutdown()
+
+    statuses = {}
+    for row in layer.rows.values():
+        statuses[row['Status']] = statuses.get(row['Status'], 0) + 1
+    print(f"Pipeline finished in {total_seconds:.1f} seconds, Esri rows by status afterwards: {statuses}")
+    report(os.path.join(workdir, 'stage_timings.json'), report_path,
+           {'meters': args.meters, 'rates': vars(rates), 'generated': counts, 'esri_latency': args.esri_latency,
+            'pipeline_args': pipeline_args, 'total_seconds': round(total_seconds, 3), 'esri_status_counts': statuses})
+
+    if not args.workspace:
+        os.chdir(repo_dir)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+
+# Local stand-ins for the live systems meter_data_integration.py talks to, so the pipeline can be benchmarked
+# without production credentials:
+#   arcpy      - an in-memory meters layer behind fake arcpy.da Search/Update/Insert cursors
+#   jaydebeapi - a SQLite database answering the two Naviline queries
+#   jpype      - a JVM that never needs starting
+#   Box / Esri - one local http server for the Box token and file download, and the layer's applyEdits endpoint
+import sys
+import os
+import types
+import hashlib
+import re
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+# Fields of the meters layer, in the order insert_rows builds its rows (GlobalID is dropped by esri_connection_setup)
+layer_fields = ['OBJECTID', 'Naviline_Service_Id', 'Meter_Number', 'Location_Id', 'Cycle', 'Sequence', 'Location_On_Property',
+                'Jurisdiction', 'ServiceType', 'Meter_Size', 'Rate_Class', 'Address', 'Install_Date', 'Meter_Make', 'Customer_Name',
+                'Register', 'Radio_Id', 'created_user', 'created_date', 'last_edited_user', 'last_edited_date', 'Status', 'Shape', 'GlobalID']
+
+
+class MetersLayer:
+    """
+    The meters layer: OBJECTID -> dict of field name -> value, with Shape stored as an (X, Y) tuple.  Every cursor
+    call sleeps latency seconds first, to stand in for the round trip to the feature server.
+    """
+    def __init__(self, latency=0.0):
+        self.rows = {}
+        self.next_object_id = 1
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.cursor_calls = 0
+
+    def add(self, values):
+        with self.lock:
+            object_id = self.next_object_id
+            self.next_object_id += 1
+            now = datetime.now().replace(microsecond=0)
+            row = {field_name: values.get(field_name) for field_name in layer_fields}
+            row.update({'OBJECTID': object_id, 'GlobalID': f"{{{object_id:08d}}}", 'created_user': 'benchmark',
+                        'created_date': now, 'last_edited_user': 'benchmark', 'last_edited_date': now})
+            self.rows[object_id] = row
+            return object_id
+
+    def select(self, where_clause):
+        time.sleep(self.latency)
+        matches = where_clause_filter(where_clause)
+        with self.lock:
+            self.cursor_calls += 1
+            return [row for row in self.rows.values() if matches(row)]
+
+
+def where_clause_filter(where_clause):
+    """
+    Turns the where clauses meter_data_integration.py sends into a row filter.  Only those forms are understood:
+    OBJECTID ranges and IN lists, Naviline_Service_Id IN lists, and the created/last edited date watermark of the
+    incremental load.
+    """
+    if not where_clause:
+        return lambda row: True
+    match = re.fullmatch(r"OBJECTID IN \(([\d, ]*)\)", where_clause)
+    if match:
+        object_ids = set(int(object_id) for object_id in match.group(1).split(',') if object_id.strip())
+        return lambda row: row['OBJECTID'] in object_ids
+    match = re.fullmatch(r"Naviline_Service_Id IN \((.*)\)", where_clause)
+    if match:
+        service_ids = set(service_id.replace("''", "'") for service_id in re.findall(r"'((?:[^']|'')*)'", match.group(1)))
+        return lambda row: row['Naviline_Service_Id'] in service_ids
+    match = re.fullmatch(r"OBJECTID >= (\d+)(?: AND OBJECTID < (\d+))?", where_clause)
+    if match:
+        low = int(match.group(1))
+        high = int(match.group(2)) if match.group(2) else None
+        return lambda row: row['OBJECTID'] >= low and (high is None or row['OBJECTID'] < high)
+    match = re.fullmatch(r"last_edited_date >= TIMESTAMP '([^']+)' OR created_date >= TIMESTAMP '([^']+)'", where_clause)
+    if match:
+        watermark = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+        return lambda row: (row['last_edited_date'] or datetime.min) >= watermark or (row['created_date'] or datetime.min) >= watermark
+    raise NotImplementedError(f"The benchmark layer doesn't understand the where clause {where_clause!r}")
+
+
+def make_arcpy(layer):
+    """
+    Builds a module with the parts of arcpy meter_data_integration.py uses, all working on layer.
+    """
+    arcpy = types.ModuleType('arcpy')
+    arcpy.da = types.ModuleType('arcpy.da')
+
+    class Field:
+        def __init__(self, name):
+            self.name = name
+
+    class Point:
+        def __init__(self, X=None, Y=None):
+            self.X = X
+            self.Y = Y
+
+    def shape_value(value):
+        return (value.X, value.Y) if isinstance(value, Point) else value
+
+    class SearchCursor:
+        def __init__(self, feature_class, field_names, where_clause=None):
+            self.field_names = list(field_names)
+            self.rows = layer.select(where_clause)
+
+        def __iter__(self):
+            for row in self.rows:
+                yield tuple(row[field_name] for field_name in self.field_names)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    class UpdateCursor(SearchCursor):
+        def __iter__(self):
+            for row in self.rows:
+                self.current = row
+                yield [row[field_name] for field_name in self.field_names]
+
+        def updateRow(self, values):
+            with layer.lock:
+                for field_name, value in zip(self.field_names, values):
+                    if field_name != 'OBJECTID':
+                        self.current[field_name] = shape_value(value)
+                self.current['last_edited_date'] = datetime.now().replace(microsecond=0)
+
+    class InsertCursor:
+        def __init__(self, feature_class, field_names):
+            self.field_names = list(field_names)
+
+        def insertRow(self, values):
+            time.sleep(layer.latency)
+            layer.add({field_name: shape_value(value) for field_name, value in zip(self.field_names, values)})
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    arcpy.SignInToPortal = lambda *args, **kwargs: None
+    arcpy.GetSigninToken = lambda: {'token': 'benchmark', 'referer': ''}
+    arcpy.ListFields = lambda feature_class: [Field(field_name) for field_name in layer_fields]
+    arcpy.Point = Point
+    arcpy.da.SearchCursor = SearchCursor
+    arcpy.da.UpdateCursor = UpdateCursor
+    arcpy.da.InsertCursor = InsertCursor
+    return arcpy
+
+
+def make_jaydebeapi(database_path, query_tables):
+    """
+    Builds a jaydebeapi module whose connections are SQLite connections to database_path.  A query is answered from
+    the table query_tables maps its text to, since the Naviline SQL itself is DB2 and can't run on SQLite.  Each
+    connection's jconn stands in for the JDBC connection underneath, with a ResultSet for the jpype extractor.
+    """
+    jaydebeapi = types.ModuleType('jaydebeapi')
+
+    def table_for(sql_query):
+        table_name = query_tables.get(sql_query.strip())
+        if table_name is None:
+            raise NotImplementedError("The benchmark Naviline database only answers the queries in sql/")
+        return table_name
+
+    class Connection:
+        def __init__(self):
+            self.connection = sqlite3.connect(database_path, check_same_thread=False)
+            self.jconn = JavaConnection(self.connection)
+
+        def cursor(self):
+            connection = self.connection
+
+            class Cursor:
+                def __init__(self):
+                    self.cursor = connection.cursor()
+                    self.description = None
+
+                def execute(self, sql_query):
+                    self.cursor.execute(f"SELECT * FROM {table_for(sql_query)}")
+                    self.description = self.cursor.description
+
+                def fetchmany(self, size):
+                    return self.cursor.fetchmany(size)
+
+                def close(self):
+                    self.cursor.close()
+
+            return Cursor()
+
+        def close(self):
+            self.connection.close()
+
+    class JavaConnection:
+        def __init__(self, connection):
+            self.connection = connection
+
+        def isValid(self, timeout):
+            return True
+
+        def createStatement(self):
+            return Statement(self.connection)
+
+    class Statement:
+        def __init__(self, connection):
+            self.connection = connection
+            self.fetch_size = 1000
+
+        def setFetchSize(self, fetch_size):
+            self.fetch_size = fetch_size
+
+        def executeQuery(self, sql_query):
+            cursor = self.connection.cursor()
+            cursor.execute(f"SELECT * FROM {table_for(sql_query)}")
+            return ResultSet(cursor, self.fetch_size)
+
+        def close(self):
+            pass
+
+    class ResultSetMetaData:
+        """
+        Column labels and java.sql.Types codes, taken from the first row's values (INTEGER, DOUBLE or VARCHAR).
+        """
+        def __init__(self, labels, first_row):
+            self.labels = labels
+            self.types = [4 if isinstance(value, int) else 8 if isinstance(value, float) else 12 for value in first_row or [None] * len(labels)]
+
+        def getColumnCount(self):
+            return len(self.labels)
+
+        def getColumnLabel(self, column):
+            return self.labels[column - 1]
+
+        def getColumnType(self, column):
+            return self.types[column - 1]
+
+        def getScale(self, column):
+            return 0
+
+        def getPrecision(self, column):
+            return 10
+
+        def isNullable(self, column):
+            return 1    # columnNullable
+
+    class ResultSet:
+        """
+        A forward-only ResultSet over a SQLite cursor, fetching fetch_size rows at a time like the jt400 driver.
+        """
+        def __init__(self, cursor, fetch_size):
+            self.cursor = cursor
+            self.fetch_size = fetch_size
+            self.rows = cursor.fetchmany(fetch_size)
+            self.position = -1
+            self.meta_data = ResultSetMetaData([description[0] for description in cursor.description], self.rows[0] if self.rows else None)
+            self.last_was_null = False
+
+        def getMetaData(self):
+            return self.meta_data
+
+        def next(self):
+            self.position += 1
+            if self.position >= len(self.rows):
+                self.rows = self.cursor.fetchmany(self.fetch_size)
+                self.position = 0
+            return self.position < len(self.rows)
+
+        def value(self, column):
+            value = self.rows[self.position][column - 1]
+            self.last_was_null = value is None or value == ''
+            return value
+
+        def getString(self, column):
+            value = self.value(column)
+            return None if value is None else str(value)
+
+        def getLong(self, column):
+            value = self.value(column)
+            return 0 if self.last_was_null else int(value)
+
+        def getDouble(self, column):
+            value = self.value(column)
+            return 0.0 if self.last_was_null else float(value)
+
+        def wasNull(self):
+            return self.last_was_null
+
+        def close(self):
+            self.cursor.close()
+
+    jaydebeapi.connect = lambda *args, **kwargs: Connection()
+    return jaydebeapi
+
+
+def make_jpype():
+    jpype = types.ModuleType('jpype')
+    jpype.isJVMStarted = lambda: False
+    jpype.startJVM = lambda *args, **kwargs: None
+    jpype.shutdownJVM = lambda: None
+    return jpype
+
+
+def install_stand_ins(layer, database_path, query_tables):
+    """
+    Puts the stand-in modules in sys.modules, so importing meter_data_integration afterwards picks them up.
+    """
+    sys.modules['arcpy'] = make_arcpy(layer)
+    sys.modules['jaydebeapi'] = make_jaydebeapi(database_path, query_tables)
+    sys.modules['jpype'] = make_jpype()
+
+
+def to_layer_value(field_name, value):
+    if field_name in ('Install_Date', 'created_date', 'last_edited_date') and value is not None:
+        return datetime.fromtimestamp(value / 1000, timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def start_local_server(layer, sensus_file):
+    """
+    Starts a local http server on a free port that answers like Box (POST /oauth2/token, GET /2.0/files/{id} and
+    GET /2.0/files/{id}/content with sensus_file) and like the meters feature server (POST /meters/applyEdits
+    with adds, which go into layer).
+    Returns - The server; its base url is http://127.0.0.1:{server.server_port}
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, value):
+            body = json.dumps(value).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+            if self.path == '/oauth2/token':
+                self.send_json({'access_token': 'benchmark', 'expires_in': 3600, 'token_type': 'bearer'})
+            elif self.path == '/meters/applyEdits':
+                time.sleep(layer.latency)
+                add_results = []
+                for feature in json.loads(form.get('adds', ['[]'])[0]):
+                    values = {field_name: to_layer_value(field_name, value) for field_name, value in feature['attributes'].items()}
+                    values['Shape'] = (feature['geometry']['x'], feature['geometry']['y'])
+                    add_results.append({'objectId': layer.add(values), 'success': True})
+                self.send_json({'addResults': add_results, 'updateResults': [], 'deleteResults': []})
+            else:
+                self.send_error(404)
+
+        def do_GET(self):
+            match = re.fullmatch(r"/2\.0/files/(\w+)(/content)?", self.path.split('?')[0])
+            if match is None:
+                self.send_error(404)
+            elif match.group(2):
+                with open(sensus_file, 'rb') as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                with open(sensus_file, 'rb') as f:
+                    sha1 = hashlib.sha1(f.read()).hexdigest()
+                modified_at = datetime.fromtimestamp(os.path.getmtime(sensus_file), timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+                self.send_json({'id': match.group(1), 'type': 'file', 'sha1': sha1, 'size': os.path.getsize(sensus_file),
+                                'modified_at': modified_at, 'file_version': {'id': sha1[:12], 'sha1': sha1}})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
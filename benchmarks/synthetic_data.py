@@ -0,0 +1,150 @@
+
+# Synthetic Naviline, inventory, Sensus and Esri data for the benchmark, with controlled rates of the problems the
+# pipeline has to deal with.  Everything comes from one seeded random generator, so a given scale and set of rates
+# always produces the same data.
+import csv
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+
+streets = ['ACADEMY ST', 'CHATHAM ST', 'HARRISON AVE', 'KILDAIRE FARM RD', 'MAYNARD RD', 'HIGH HOUSE RD', 'WALNUT ST', 'CARY PKWY']
+meter_makes = ['SENSUS', 'NEPTUNE', 'BADGER']
+meter_sizes = ['5/8', '3/4', '1', '1.5', '2']
+rate_classes = ['RES', 'COM', 'IRR', 'MF']
+locations_on_property = ['FRONT', 'REAR', 'LEFT SIDE', 'RIGHT SIDE', 'CURB']
+inventory_issue_types = ['CLEAN-ACTIVE/INSTALLED'] * 20 + ['CLEAN-ACTIVE/USED_INVENTORY', 'CLEAN-ACTIVE/NEW_INVENTORY', 'CLEAN-PURGED/SCRAPPED_INVENTORY',
+                         'PURGED/INSTALLED', 'ACTIVE/INSTALLED/WAREHOUSE', 'NOT_INSTALLED/NO_WAREHOUSE', 'AUDIT_METER', 'UNKNOWN']
+
+
+class SyntheticRates:
+    """
+    Fractions of the meters that get each kind of problem.
+    duplicate   - Naviline and Sensus rows repeated with the same service id / radio and meter number
+    missing_key - Naviline rows with no RADIO or REGISTER, Sensus rows with no radio id
+    wrong_radio - Sensus rows whose radio id doesn't match the Naviline RADIO for the meter
+    drift       - Sensus coordinates pushed outside the service area
+    change      - Naviline rows whose address or customer changed since the Esri row was written (updates)
+    add         - Naviline services with no Esri row yet (adds)
+    remove      - Esri rows for services no longer in Naviline (removes)
+    """
+    def __init__(self, duplicate=0.005, missing_key=0.01, wrong_radio=0.01, drift=0.005, change=0.05, add=0.02, remove=0.01):
+        self.duplicate = duplicate
+        self.missing_key = missing_key
+        self.wrong_radio = wrong_radio
+        self.drift = drift
+        self.change = change
+        self.add = add
+        self.remove = remove
+
+
+def generate(meters, rates, database_path, sensus_path, layer, naviline_fields, inventory_fields, sensus_header, seed=0):
+    """
+    Writes the Naviline query results to two SQLite tables (naviline_meters, naviline_inventory), the Sensus Box
+    file to sensus_path and the Esri rows into layer.
+    Param - meters: (int) Number of meters
+    Param - rates: (SyntheticRates) Problem rates
+    Param - naviline_fields, inventory_fields, sensus_header: (list) Columns of each source, from meter_data_integration
+    Returns - A dict of how many rows of each kind were generated
+    """
+    generator = random.Random(seed)
+    counts = {'naviline': 0, 'inventory': 0, 'sensus': 0, 'esri': 0}
+    naviline_rows = []
+    inventory_rows = []
+    base_install = datetime(2005, 1, 1)
+
+    with open(sensus_path, 'w', newline='') as sensus_file:
+        sensus_writer = csv.writer(sensus_file)
+        for i in range(meters):
+            location_id = 100000 + i
+            sequence = 1 + (i % 3 == 0)
+            service_id = f"{location_id:09d}-WA-{sequence:05d}"
+            register = str(30000000 + i)
+            radio = str(1500000000 + i)
+            cycle = generator.randint(1, 20)
+            install_date = (base_install + timedelta(days=generator.randint(0, 7000))).strftime("%Y-%m-%d")
+            latitude = generator.uniform(35.66, 35.88)
+            longitude = generator.uniform(-78.95, -78.74)
+
+            naviline = {
+                'NAVILINE_SERVICE_ID': service_id, 'METERNUMBER': register, 'LOCATIONID': location_id,
+                'LOCATION_ON_PROPERTY': generator.choice(locations_on_property), 'SERVICETYPE': 'WA',
+                'METER_SIZE': generator.choice(meter_sizes), 'SEQNUMB': sequence,
+                'ADDRESS': f"{generator.randint(100, 9999)} {generator.choice(streets)}", 'CYCLENUMB': cycle,
+                'INSTALLDATE': install_date, 'CYCLEROUTE': f"{cycle:02d}-{generator.randint(1, 40):03d}",
+                'METER_MAKE': generator.choice(meter_makes), 'RADIO': radio, 'REGISTER': register, 'JURISDICTION': 'CARY',
+                'RATE_CLASS': generator.choice(rate_classes), 'CUSTNAME': f"CUSTOMER {i}", 'MASKEDMETERNUMB': '****' + register[-4:]
+            }
+            esri_values = dict(naviline)
+            if generator.random() < rates.change:
+                naviline['ADDRESS'] = f"{generator.randint(100, 9999)} {generator.choice(streets)}"
+            if generator.random() < rates.missing_key:
+                naviline[generator.choice(['RADIO', 'REGISTER'])] = ''
+            naviline_rows.append([naviline[field_name] for field_name in naviline_fields])
+            if generator.random() < rates.duplicate:
+                naviline_rows.append([naviline[field_name] for field_name in naviline_fields])
+
+            inventory = {field_name: '' for field_name in inventory_fields}
+            inventory.update({
+                'METERNUMBER': register, 'CUSTOMERID': 500000 + i, 'LOCATIONID': location_id, 'SERVICETYPE': 'WA',
+                'NAVILINE_SERVICE_ID': service_id, 'METER_STATUS': 'ACTIVE', 'METER_SERVICE': 'WA', 'SEQNUMB': sequence,
+                'METER_SIZE': naviline['METER_SIZE'], 'MULTIPLIER': 1.0, 'METER_MAKE': naviline['METER_MAKE'], 'METER_STYLE': 'R',
+                'INSTALLDATE': install_date, 'MANUFACTURE_DATE': install_date, 'PURCHASE_DATE': install_date, 'RADIO': radio,
+                'REGISTER': register, 'LAST_INSTALL_EVENT_DATE': install_date, 'LAST_INSTALL_EVENT_TYPE': 'INSTALL',
+                'DATA_ISSUE_TYPE': generator.choice(inventory_issue_types)
+            })
+            inventory_rows.append([inventory[field_name] for field_name in inventory_fields])
+
+            sensus_radio = radio
+            if generator.random() < rates.wrong_radio:
+                sensus_radio = str(1700000000 + i)
+            elif generator.random() < rates.missing_key:
+                sensus_radio = ''
+            if generator.random() < rates.drift:
+                latitude += 0.5
+            sensus = [f"{column_name}{i % 5}" for column_name in sensus_header]
+            for column_name, value in [('SensusRadioId', sensus_radio), ('SensusMeterNumber', register), ('Value3', install_date),
+                                       ('SensusLatitude', f"{latitude:.6f}"), ('SensusLongitude', f"{longitude:.6f}")]:
+                sensus[sensus_header.index(column_name)] = value
+            sensus_writer.writerow(sensus)
+            counts['sensus'] += 1
+            if generator.random() < rates.duplicate:
+                sensus_writer.writerow(sensus)
+                counts['sensus'] += 1
+
+            if generator.random() >= rates.add:
+                layer.add(esri_row(esri_values, generator))
+                counts['esri'] += 1
+
+        for i in range(int(meters * rates.remove)):
+            retired = {'NAVILINE_SERVICE_ID': f"{900000 + i:09d}-WA-00001", 'METERNUMBER': str(80000000 + i), 'LOCATIONID': 900000 + i,
+                       'LOCATION_ON_PROPERTY': 'FRONT', 'SERVICETYPE': 'WA', 'METER_SIZE': '5/8', 'SEQNUMB': 1,
+                       'ADDRESS': f"{generator.randint(100, 9999)} {generator.choice(streets)}", 'CYCLENUMB': 1, 'INSTALLDATE': '2001-01-01',
+                       'METER_MAKE': 'SENSUS', 'RADIO': str(1800000000 + i), 'REGISTER': str(80000000 + i), 'JURISDICTION': 'CARY',
+                       'RATE_CLASS': 'RES', 'CUSTNAME': f"FORMER CUSTOMER {i}"}
+            layer.add(esri_row(retired, generator))
+            counts['esri'] += 1
+
+    database = sqlite3.connect(database_path)
+    try:
+        with database:
+            for table_name, field_names, rows in [('naviline_meters', naviline_fields, naviline_rows), ('naviline_inventory', inventory_fields, inventory_rows)]:
+                database.execute(f"DROP TABLE IF EXISTS {table_name}")
+                database.execute(f"CREATE TABLE {table_name} ({', '.join(field_names)})")
+                database.executemany(f"INSERT INTO {table_name} VALUES ({', '.join('?' for field_name in field_names)})", rows)
+    finally:
+        database.close()
+    counts['naviline'] = len(naviline_rows)
+    counts['inventory'] = len(inventory_rows)
+    return counts
+
+
+def esri_row(naviline, generator):
+    return {
+        'Naviline_Service_Id': naviline['NAVILINE_SERVICE_ID'], 'Meter_Number': naviline['METERNUMBER'], 'Location_Id': naviline['LOCATIONID'],
+        'Cycle': naviline['CYCLENUMB'], 'Sequence': naviline['SEQNUMB'], 'Location_On_Property': naviline['LOCATION_ON_PROPERTY'],
+        'Jurisdiction': naviline['JURISDICTION'], 'ServiceType': naviline['SERVICETYPE'], 'Meter_Size': naviline['METER_SIZE'],
+        'Rate_Class': naviline['RATE_CLASS'], 'Address': naviline['ADDRESS'], 'Install_Date': datetime.strptime(naviline['INSTALLDATE'], "%Y-%m-%d"),
+        'Meter_Make': naviline['METER_MAKE'], 'Customer_Name': naviline['CUSTNAME'], 'Register': naviline['REGISTER'],
+        'Radio_Id': naviline['RADIO'], 'Status': 1, 'Shape': (generator.uniform(2000000, 2080000), generator.uniform(700000, 760000))
+    }
@@ -1,19 +1,35 @@
 
 # Required Libraries
+import time                           # Timing of the fetch phase and startup
+startup_start = time.perf_counter()
 import petl as etl                    # ETL (Extract, Transform, Load) operations
-import requests                       # for http connection to get box file
+import requests                       # for http connection to get box file and Esri applyEdits
+import json                           # Encode applyEdits payloads
+import calendar                       # datetime -> epoch milliseconds for applyEdits
 import pprint                         # Pretty printing for easier reading of nested structures
 from pyproj import Transformer        # Used for coordinate system transformation
+import numpy as np                    # Arrays for projecting all coordinates in one call
 import os                             # Used for file/directory creation
+import sys                            # Platform check for the peak RSS units
 import stat                           # Used for file permissions
-import arcpy                          # Used to insert/update data in arcGIS
+import shutil                         # Copy of an unchanged Sensus file when it can't be hard linked
 import configparser                   # Read config file to get credentials
 import argparse                       # Used for command line arguments
-import jaydebeapi                     # Used to connect to Naviline DB
-import jpype                          # Used for interactive java calls (so we can use jaydebeapi)
+import csv                            # Used to stream views out to csv files
+import io                             # Text wrapper for the quoted Sensus records handed to csv
+import mmap                           # Memory-mapped read of the Sensus file
+import random                         # Synthetic rows for the Sensus reader benchmark
+import threading                      # Lock so threaded exports don't interleave summary lines
+from concurrent.futures import ThreadPoolExecutor  # Bounded pool for running exports in parallel
+from concurrent.futures import wait, FIRST_EXCEPTION, FIRST_COMPLETED  # Waiting on fetch and Esri batch futures
+import pickle                         # Stage checkpoints for --resume_from
+import cProfile                       # --profile
+import pstats                         # Readable report of the --profile output
+from contextlib import contextmanager # stage_timer
 from datetime import date             # Get current date for file naming
 from datetime import datetime         # for strptime 
-from arcgis import GIS
+from functools import lru_cache       # Memoize repeated date values during conversion
+from petl.util.base import Table      # Base class for the source pass counting view
 
 
 pp = pprint.PrettyPrinter(indent=4)
@@ -25,31 +41,111 @@ output_data_subdir = 'output/'
 naviline_query_file = 'sql/Meter_Query_for_esri.sql'
 naviline_inventory_query_file = 'sql/complete_meter_inventory.sql'
 
+# Number of times each raw source (csv file, query result, etc) has been read from the top during this run
+source_passes = {}
+
+summary_file = None
+summary_lock = threading.Lock()
+# When set (see --export_threads), export_view_to_file hands its work to this pool instead of writing inline
+export_pool = None
+pending_exports = []
+
+# Number of non-empty values that failed to convert, keyed by (source name, field name).  Filled in by convert_to_schema
+conversion_failures = {}
+conversion_failures_lock = threading.Lock()     # the Esri partition readers convert on their own threads
+# Distinct date strings remembered per date column while converting
+datetime_cache_size = 4096
+
+# Stages of main(), in order.  Each one checkpoints its outputs to {workdir}/checkpoints so a run can be resumed
+pipeline_stages = ['fetch', 'convert', 'clean', 'reconcile', 'plan_edits', 'apply_edits']
+# Open edit journal and the (kind, key) pairs it held from earlier attempts, see open_edit_journal
+edit_journal = None
+journal_lock = threading.Lock()
+journaled_edits = set()
+# Written to the workdir once a run's Esri edits have all gone in, see get_naviline_delta
+edits_applied_marker_name = 'esri_edits_applied.json'
+
+# Wall time, rows and peak memory of every step timed with stage_timer, written to {workdir}/stage_timings.json
+stage_timings = []
+stage_timings_lock = threading.Lock()
+
+# arcpy (used to insert/update data in arcGIS), jaydebeapi (used to connect to Naviline DB) and jpype (used for
+# interactive java calls, so we can use jaydebeapi) are slow to import, so they're only imported by the connection
+# setups below.  A --dont_fetch --noupdate run never needs them.
+arcpy = None
+jaydebeapi = None
+jpype = None
+
+# Set by esri_connection_setup, cleared when a daemon cycle fails so the next one signs in again
+esri_signed_in = False
+# Idle Naviline connections kept for the next query (up to NAVILINE_POOL_SIZE), see checkout_naviline_connection
+naviline_pool = []
+naviline_pool_lock = threading.Lock()
+# Box access token and the time.monotonic() it stops being used, see get_box_token
+box_token = None
+box_token_expires = 0
+
 # Set up arcgis connection
 config = configparser.ConfigParser()
 config.read('configs/config.ini')
 
+def import_esri_modules():
+    global arcpy
+    if arcpy is None:
+        start = time.perf_counter()
+        import arcpy
+        stat_output(f"Import time for arcpy: {time.perf_counter() - start:.1f} seconds")
+
+def import_naviline_modules():
+    global jaydebeapi
+    global jpype
+    with naviline_pool_lock:
+        if jaydebeapi is None:
+            start = time.perf_counter()
+            import jaydebeapi
+            import jpype
+            stat_output(f"Import time for jaydebeapi and jpype: {time.perf_counter() - start:.1f} seconds")
+
 def esri_connection_setup():
     global meters_feature_server
     global esri_meter_fields
     global esri_batch_size
     
+    import_esri_modules()
     #Esri Query Setup
     arcgis_user = config['Credentials']['ARCGIS_USER']
     arcgis_pass = config['Credentials']['ARCGIS_PASSWORD']
 
     # # Connect to GIS
     
-    meters_feature_server = "https://maps-apis.carync.gov/server/rest/services/Infrastructure/MetersInternal/FeatureServer/0" # service url
+    meters_feature_server = config.get('Misc', 'METERS_FEATURE_SERVER', fallback="https://maps-apis.carync.gov/server/rest/services/Infrastructure/MetersInternal/FeatureServer/0") # service url
     arcpy.SignInToPortal("https://maps.carync.gov/portal/", arcgis_user, arcgis_pass)
     esri_meter_fields = [f.name for f in arcpy.ListFields(meters_feature_server)]
     esri_meter_fields.remove("GlobalID")
     #pp.pprint(esri_meter_fields)
     esri_batch_size = 100  # Process 100 elements at a time
+    global esri_signed_in
+    esri_signed_in = True
 
-def navline_connection_setup():
+def ensure_esri_connection():
+    """
+    Runs esri_connection_setup unless an earlier call is still signed in, so a daemon keeps one portal session for
+    as long as the portal keeps giving out tokens for it.
+    """
+    if esri_signed_in:
+        try:
+            if arcpy.GetSigninToken():
+                return
+        except Exception as e:
+            print(f"Esri session check failed, signing in again: {e}")
+    esri_connection_setup()
 
-    global nav_conn
+def connect_to_naviline():
+    """
+    Opens a new Naviline connection, starting the JVM first if this is the first one.  
+    Returns - The jaydebeapi connection
+    """
+    import_naviline_modules()
     #Naviline Query Setup
     naviline_user = config['Credentials']['NAVILINE_USER']
     naviline_pass = config['Credentials']['NAVILINE_PASSWORD']
@@ -63,8 +159,9 @@ def navline_connection_setup():
     jdbc_url = f"jdbc:as400://{db_host}/{db_name}"
     # JDBC driver class
     driver_class = "com.ibm.as400.access.AS400JDBCDriver"
-    if not jpype.isJVMStarted():
-        jpype.startJVM(classpath=[jdbc_jar_path])
+    with naviline_pool_lock:
+        if not jpype.isJVMStarted():
+            jpype.startJVM(classpath=[jdbc_jar_path])
 
     nav_conn = jaydebeapi.connect(
             driver_class,
@@ -72,6 +169,44 @@ def navline_connection_setup():
             [naviline_user, naviline_pass],
             jdbc_jar_path)
     print(f"Connected to {db_name} on {db_host}")
+    return nav_conn
+
+def checkout_naviline_connection():
+    """
+    Takes an idle connection from the pool, checking it still answers first, or opens a new one if there's none.  
+    Returns - A jaydebeapi connection, to be given back with checkin_naviline_connection
+    """
+    while True:
+        with naviline_pool_lock:
+            connection = naviline_pool.pop() if naviline_pool else None
+        if connection is None:
+            return connect_to_naviline()
+        try:
+            if connection.jconn.isValid(5):
+                return connection
+        except Exception:
+            pass
+        discard_naviline_connection(connection)
+
+def checkin_naviline_connection(connection):
+    with naviline_pool_lock:
+        if len(naviline_pool) < config.getint('Misc', 'NAVILINE_POOL_SIZE', fallback=2):
+            naviline_pool.append(connection)
+            return
+    discard_naviline_connection(connection)
+
+def discard_naviline_connection(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+def close_naviline_connections():
+    with naviline_pool_lock:
+        connections = list(naviline_pool)
+        naviline_pool.clear()
+    for connection in connections:
+        discard_naviline_connection(connection)
 
 
 
@@ -123,187 +258,588 @@ def safe_float_conversion(string):
         return float(str(string))
     except:
         return None
+
+# Fixed width parsers for the date layouts safe_datetime_conversion knows about.  Each returns None if the string
+# isn't in its layout, so safe_datetime_conversion gets the final say; datetime() still validates the ranges.
+def is_ascii_digits(string):
+    # int() also takes signs, spaces and non-ASCII digits, which strptime would reject
+    return string.isascii() and string.isdigit()
+
+def parse_fixed_date(string):
+    if len(string) != 10 or string[4] != '-' or string[7] != '-':
+        return None
+    if not (is_ascii_digits(string[0:4]) and is_ascii_digits(string[5:7]) and is_ascii_digits(string[8:10])):
+        return None
+    return datetime(int(string[0:4]), int(string[5:7]), int(string[8:10]))
+
+def parse_fixed_date_time(string):
+    # "%Y-%m-%d %H:%M:%S", with or without a trailing .%f (the fraction is dropped, like safe_datetime_conversion does)
+    if len(string) > 19 and not (string[19] == '.' and 20 < len(string) <= 26 and is_ascii_digits(string[20:])):
+        return None
+    if len(string) < 19 or string[4] != '-' or string[7] != '-' or string[10] != ' ' or string[13] != ':' or string[16] != ':':
+        return None
+    fields = [string[0:4], string[5:7], string[8:10], string[11:13], string[14:16], string[17:19]]
+    if not all(is_ascii_digits(field) for field in fields):
+        return None
+    return datetime(*[int(field) for field in fields])
+
+def parse_fixed_compact_date_time(string):
+    if len(string) != 14 or not is_ascii_digits(string):
+        return None
+    return datetime(int(string[0:4]), int(string[4:6]), int(string[6:8]), int(string[8:10]), int(string[10:12]), int(string[12:14]))
+
+datetime_layouts = {
+    "%Y-%m-%d": parse_fixed_date,
+    "%Y-%m-%d %H:%M:%S": parse_fixed_date_time,
+    "%Y-%m-%d %H:%M:%S.%f": parse_fixed_date_time,
+    "%Y%m%d%H%M%S": parse_fixed_compact_date_time
+}
+
+def detect_datetime_layout(string):
+    """
+    Returns the fixed width parser for the first layout that strptime accepts for the string, or None
+    """
+    for fmt, parser in datetime_layouts.items():
+        try:
+            datetime.strptime(string, fmt)
+            return parser
+        except ValueError:
+            continue
+    return None
+
+def make_datetime_conversion():
+    """
+    Builds a datetime conversion for one column.  The layout is detected from the first value that parses, after
+    that values go through the fixed width parser for that layout and only fall back to safe_datetime_conversion
+    when they don't fit.  Results are memoized, install dates repeat a lot.  
+    Returns - A function that converts one value, returning None if it isn't a datetime
+    """
+    layout_parser = None
+
+    @lru_cache(maxsize=datetime_cache_size)
+    def convert_string(string):
+        nonlocal layout_parser
+        if layout_parser is None:
+            layout_parser = detect_datetime_layout(string)
+        if layout_parser is not None:
+            try:
+                parsed = layout_parser(string)
+                if parsed is not None:
+                    return parsed
+            except ValueError:
+                pass
+        return safe_datetime_conversion(string)
+
+    def convert(value):
+        if (value == None or value == ""): return None
+        if isinstance(value, datetime):
+            return value.replace(microsecond=0)
+        return convert_string(str(value))
+
+    return convert
+
+def make_counted_conversion(source_name, field_name, field_type):
+    """
+    Builds the conversion for one field of a schema, counting values that weren't empty but still came back None.  
+    Param - source_name: (string) The name of the source (ex. Naviline, Sensus, etc) used in the failure report  
+    Param - field_name: (string) The field being converted  
+    Param - field_type: (string) One of 'string', 'int', 'float' or 'datetime'  
+    Returns - A function that converts one value
+    """
+    if field_type == 'datetime':
+        conversion = make_datetime_conversion()
+    else:
+        conversion = {'string': safe_string_conversion, 'int': safe_int_conversion, 'float': safe_float_conversion}[field_type]
+    failure_key = (source_name, field_name)
+    conversion_failures.setdefault(failure_key, 0)
+
+    def convert(value):
+        converted = conversion(value)
+        if converted is None and not (value == None or value == ""):
+            with conversion_failures_lock:
+                conversion_failures[failure_key] += 1
+        return converted
+
+    return convert
+
+def convert_to_schema(view, schema, source_name):
+    """
+    Converts the fields of a view to the types given in a schema.  
+    Param - view: (view) The view to convert  
+    Param - schema: (dict) field name -> 'string', 'int', 'float' or 'datetime'  
+    Param - source_name: (string) The name of the source (ex. Naviline, Sensus, etc) used in the failure report  
+    Returns - A new view (view) with converted fields
+    """
+    return etl.convert(view, {field_name: make_counted_conversion(source_name, field_name, field_type) for field_name, field_type in schema.items()})
+
+def report_conversion_failures():
+    """
+    Outputs the conversion failures of every source and field to stat_output, then a total per source.
+    """
+    source_totals = {}
+    for (source_name, field_name), failures in conversion_failures.items():
+        source_totals[source_name] = source_totals.get(source_name, 0) + failures
+        if failures > 0:
+            stat_output(f"Number of {source_name} {field_name} values that failed conversion: {failures}")
+    for source_name, failures in source_totals.items():
+        stat_output(f"Number of {source_name} values that failed conversion: {failures}")
+
+# Typed columnar snapshots (SNAPSHOT_FORMAT = arrow in config.ini) sit next to the workdir csvs as {name}.arrow so
+# --dont_fetch reruns can skip csv parsing and conversion.  pyarrow is only imported when they're turned on.
+def columnar_snapshots_enabled():
+    return config.get('Misc', 'SNAPSHOT_FORMAT', fallback='csv').strip().lower() == 'arrow'
+
+def columnar_snapshot_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.arrow'
+
+def csv_signature(csv_path):
+    """
+    The size and modified time (ns) of a csv, as snapshot schema metadata.  A snapshot only stands for the csv it
+    was written from: a csv fetched again, or an earlier Sensus file linked in by transfer_sensus_data (which keeps
+    its own, older, modified time), won't match.  
+    Returns - A dict of bytes -> bytes, or None if the csv doesn't exist
+    """
+    if not os.path.exists(csv_path):
+        return None
+    csv_stat = os.stat(csv_path)
+    return {b'csv_size': str(csv_stat.st_size).encode(), b'csv_mtime_ns': str(csv_stat.st_mtime_ns).encode()}
+
+def write_columnar_snapshot(table, csv_path, schema):
+    """
+    Writes a typed table to an Arrow IPC file next to its csv, keeping ints, floats and datetimes as such.  The
+    csv's size and modified time go in the schema metadata, see csv_signature.  Does nothing unless
+    SNAPSHOT_FORMAT = arrow.  Fields missing from the schema are left for pyarrow to infer.  
+    Param - table: (view) The typed table to write  
+    Param - csv_path: (string) The path of the csv the snapshot belongs to  
+    Param - schema: (dict) field name -> 'string', 'int', 'float' or 'datetime'
+    """
+    if not columnar_snapshots_enabled():
+        return
+    import pyarrow as pa
+    arrow_types = {'string': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'datetime': pa.timestamp('us')}
+
+    header = list(etl.header(table))
+    rows = list(iter(etl.data(table)))
+    arrays = []
+    for index, field_name in enumerate(header):
+        values = [row[index] for row in rows]
+        if field_name in schema:
+            arrays.append(pa.array(values, type=arrow_types[schema[field_name]]))
+        else:
+            arrays.append(pa.array(values))
+    arrow_table = pa.Table.from_arrays(arrays, names=header).replace_schema_metadata(csv_signature(csv_path))
+
+    with pa.OSFile(columnar_snapshot_path(csv_path), 'wb') as sink:
+        with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+
+def read_columnar_snapshot(csv_path):
+    """
+    Reads the Arrow IPC snapshot of a workdir csv through a memory map.  The snapshot is only used when
+    SNAPSHOT_FORMAT = arrow and the csv still has the size and modified time recorded in it, so a csv that was
+    replaced after the snapshot was written wins.  
+    Param - csv_path: (string) The path of the csv the snapshot belongs to  
+    Returns - A materialized PETL table with typed values, or None if there's no usable snapshot
+    """
+    snapshot_path = columnar_snapshot_path(csv_path)
+    if not columnar_snapshots_enabled() or not os.path.exists(snapshot_path):
+        return None
+    signature = csv_signature(csv_path)
+    if signature is None:
+        return None
+    import pyarrow as pa
+    with pa.memory_map(snapshot_path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        if reader.schema.metadata != signature:
+            return None
+        arrow_table = reader.read_all()
+        columns = [column.to_pylist() for column in arrow_table.columns]
+    source_passes[os.path.basename(snapshot_path)] = source_passes.get(os.path.basename(snapshot_path), 0) + 1
+    return etl.wrap([tuple(arrow_table.column_names)] + list(zip(*columns)))
     
 
 # Function to convert latitude and longitude to state plane coordinates
-def convert_lat_long_to_state_plane(val,row) -> tuple:
+def project_sensus_to_state_plane(dm_load):
+    '''
+    Projects every Sensus latitude/longitude to NC State Plane in a single transformer call and adds the
+    result as X and Y fields.  Rows missing either coordinate get (0,0).  The result is materialized, so the
+    projection runs once no matter how many times the table is read.  
+    Param - dm_load: (view) The view containing typed sensus data  
+    Returns - A new table (view) with X and Y fields added
+    '''
+    rows = list(iter(etl.data(dm_load)))
+    latitude_index = etl.header(dm_load).index('SensusLatitude')
+    longitude_index = etl.header(dm_load).index('SensusLongitude')
+
+    latitudes = np.array([row[latitude_index] for row in rows], dtype=float)    # None becomes nan
+    longitudes = np.array([row[longitude_index] for row in rows], dtype=float)
+    missing = np.isnan(latitudes) | np.isnan(longitudes)
+
+    x, y = transformer.transform(latitudes, longitudes)
+    x = np.round(x, 1).tolist()
+    y = np.round(y, 1).tolist()
+
+    projected = [tuple(etl.header(dm_load)) + ('X', 'Y')]
+    for i, row in enumerate(rows):
+        if missing[i]:
+            projected.append(tuple(row) + (0, 0))
+        else:
+            projected.append(tuple(row) + (x[i], y[i]))
+    return etl.wrap(projected)
+
+class CountedSourceView(Table):
+    """
+    Wraps a raw source view and counts every full pass petl makes over it.  Because petl views are lazy, every
+    downstream view that isn't materialized re-reads its source, so this shows how often that actually happened.
+    """
+    def __init__(self, source, source_name):
+        self.source = source
+        self.source_name = source_name
+        source_passes.setdefault(source_name, 0)
 
-    if (row.SensusLongitude ==  None or row.SensusLatitude == None):
-        return (0,0)      
-    longitude = row.SensusLongitude
-    latitude = row.SensusLatitude
-    out = transformer.transform(latitude, longitude)
-    return round(out[0],1),round(out[1],1)
+    def __iter__(self):
+        source_passes[self.source_name] += 1
+        return iter(self.source)
+
+def materialize(view):
+    """
+    Stage boundary.  Evaluates a lazy petl view once and keeps the rows in memory, so every join and export
+    downstream reuses the result instead of re-running the whole chain back to the source.  
+    Param - view: (view) The petl view to evaluate  
+    Returns - A petl table backed by an in-memory list
+    """
+    # iter() so list() doesn't call len() on the view, which is a full extra pass in petl
+    return etl.wrap(list(iter(view)))
+
+def report_source_passes():
+    total_passes = sum(source_passes.values())
+    for source_name, passes in source_passes.items():
+        stat_output(f"Number of passes over {source_name} source: {passes}")
+    stat_output(f"Number of source passes made this run: {total_passes}")
 
 # Helper to log output both to screen and summary file
 def stat_output(string):
-    print(string)
-    summary_file.write(string + '\n')
+    with summary_lock:
+        print(string)
+        summary_file.write(string + '\n')
 
 def read_sql_query(file_path):
     with open(file_path, "r") as file:
         return file.read()
 
-def convert_naviline_to_proper_types(nv_load):
-    return etl.convert(nv_load, 
-                                  {
-                                      'NAVILINE_SERVICE_ID': safe_string_conversion,
-                                      'METERNUMBER': safe_string_conversion,
-                                      'LOCATIONID': safe_int_conversion,
-                                      'LOCATION_ON_PROPERTY': safe_string_conversion,
-                                      'SERVICETYPE': safe_string_conversion,
-                                      'METER_SIZE': safe_string_conversion,
-                                      'SEQNUMB': safe_int_conversion,
-                                      'ADDRESS': safe_string_conversion,
-                                      'CYCLENUMB': safe_int_conversion,
-                                      'INSTALLDATE': safe_datetime_conversion,
-                                      'CYCLEROUTE': safe_string_conversion,
-                                      'METER_MAKE': safe_string_conversion,
-                                      'RADIO': safe_string_conversion,
-                                      'REGISTER': safe_string_conversion,
-                                      'JURISDICTION': safe_string_conversion,
-                                      'RATE_CLASS': safe_string_conversion,
-                                      'CUSTNAME': safe_string_conversion,
-                                      'MASKEDMETERNUMB': safe_string_conversion
-                                    }
-                                )
-def convert_nv_inventory_to_proper_types(nv_load):
-    return etl.convert(nv_load, 
-                                  {
-                                      'METERNUMBER': safe_string_conversion,
-                                      'CUSTOMERID': safe_int_conversion,
-                                      'LOCATIONID': safe_int_conversion,
-                                      'SERVICETYPE': safe_string_conversion,
-                                      'NAVILINE_SERVICE_ID': safe_string_conversion,
-                                      'METER_STATUS': safe_string_conversion,
-                                      'METER_SERVICE': safe_string_conversion,
-                                      'SEQNUMB': safe_int_conversion,
-                                      'METER_SIZE': safe_string_conversion,
-                                      'MULTIPLIER': safe_float_conversion,
-                                      'METER_MAKE': safe_string_conversion,
-                                      'METER_STYLE': safe_string_conversion,
-                                      'WAREHOUSE_CODE': safe_string_conversion,
-                                      'INSTALLDATE': safe_datetime_conversion,
-                                      'MANUFACTURE_DATE': safe_datetime_conversion,
-                                      'PURCHASE_DATE': safe_datetime_conversion,
-                                      'RADIO': safe_string_conversion,
-                                      'REGISTER': safe_string_conversion,
-                                      'LAST_INSTALL_EVENT_DATE': safe_datetime_conversion,
-                                      'LAST_INSTALL_EVENT_TYPE': safe_string_conversion,
-                                      'DATA_ISSUE_TYPE': safe_string_conversion
-                                    }
-                                )
-
-def convert_dm_to_proper_types(dm_load):
-    return etl.convert(dm_load, 
-                                  { 'SensusRadioId': safe_string_conversion,
-                                   'SensusMeterNumber': safe_string_conversion,
-                                   'SensusDateOfInstallation': safe_datetime_conversion,
-                                   'SensusLatitude': safe_float_conversion, 
-                                   'SensusLongitude': safe_float_conversion}
-                                )
-
-def convert_esri_to_proper_types(esri_load):
-    return etl.convert(esri_load, {'Esri_OBJECTID': safe_int_conversion, 
-                                   'Esri_Naviline_Service_Id': safe_string_conversion,
-                                   'Esri_Meter_Number': safe_string_conversion,
-                                    'Esri_Location_Id': safe_int_conversion,
-                                    'Esri_Cycle': safe_int_conversion,
-                                    'Esri_Sequence': safe_int_conversion,
-                                    'Esri_Location_On_Property': safe_string_conversion,
-                                    'Esri_Jurisdiction': safe_string_conversion,
-                                    'Esri_ServiceType': safe_string_conversion,
-                                    'Esri_Meter_Size': safe_string_conversion,
-                                    'Esri_Rate_Class': safe_string_conversion,
-                                    'Esri_Address': safe_string_conversion,
-                                    'Esri_Meter_Make': safe_string_conversion,
-                                    'Esri_Customer_Name': safe_string_conversion,
-                                    'Esri_Register': safe_string_conversion,
-                                    'Esri_Radio_Id': safe_string_conversion,
-                                    'Esri_created_user': safe_string_conversion,
-                                    'Esri_last_edited_user': safe_string_conversion,
-                                    'Esri_Status': safe_int_conversion,
-                                    'Esri_Install_Date': safe_datetime_conversion,
-                                    'Esri_created_date': safe_datetime_conversion,
-                                    'Esri_last_edited_date': safe_datetime_conversion,
-                                    'Esri_X': safe_float_conversion,
-                                    'Esri_Y': safe_float_conversion})
-
-def query_naviline_data(query_file):
-    data_out = None
+# Field types for each source, used by convert_to_schema
+naviline_schema = {
+    'NAVILINE_SERVICE_ID': 'string',
+    'METERNUMBER': 'string',
+    'LOCATIONID': 'int',
+    'LOCATION_ON_PROPERTY': 'string',
+    'SERVICETYPE': 'string',
+    'METER_SIZE': 'string',
+    'SEQNUMB': 'int',
+    'ADDRESS': 'string',
+    'CYCLENUMB': 'int',
+    'INSTALLDATE': 'datetime',
+    'CYCLEROUTE': 'string',
+    'METER_MAKE': 'string',
+    'RADIO': 'string',
+    'REGISTER': 'string',
+    'JURISDICTION': 'string',
+    'RATE_CLASS': 'string',
+    'CUSTNAME': 'string',
+    'MASKEDMETERNUMB': 'string'
+}
+
+nv_inventory_schema = {
+    'METERNUMBER': 'string',
+    'CUSTOMERID': 'int',
+    'LOCATIONID': 'int',
+    'SERVICETYPE': 'string',
+    'NAVILINE_SERVICE_ID': 'string',
+    'METER_STATUS': 'string',
+    'METER_SERVICE': 'string',
+    'SEQNUMB': 'int',
+    'METER_SIZE': 'string',
+    'MULTIPLIER': 'float',
+    'METER_MAKE': 'string',
+    'METER_STYLE': 'string',
+    'WAREHOUSE_CODE': 'string',
+    'INSTALLDATE': 'datetime',
+    'MANUFACTURE_DATE': 'datetime',
+    'PURCHASE_DATE': 'datetime',
+    'RADIO': 'string',
+    'REGISTER': 'string',
+    'LAST_INSTALL_EVENT_DATE': 'datetime',
+    'LAST_INSTALL_EVENT_TYPE': 'string',
+    'DATA_ISSUE_TYPE': 'string'
+}
+
+dm_schema = {
+    'SensusRadioId': 'string',
+    'SensusMeterNumber': 'string',
+    'SensusDateOfInstallation': 'datetime',
+    'SensusLatitude': 'float',
+    'SensusLongitude': 'float'
+}
+
+esri_schema = {
+    'Esri_OBJECTID': 'int',
+    'Esri_Naviline_Service_Id': 'string',
+    'Esri_Meter_Number': 'string',
+    'Esri_Location_Id': 'int',
+    'Esri_Cycle': 'int',
+    'Esri_Sequence': 'int',
+    'Esri_Location_On_Property': 'string',
+    'Esri_Jurisdiction': 'string',
+    'Esri_ServiceType': 'string',
+    'Esri_Meter_Size': 'string',
+    'Esri_Rate_Class': 'string',
+    'Esri_Address': 'string',
+    'Esri_Meter_Make': 'string',
+    'Esri_Customer_Name': 'string',
+    'Esri_Register': 'string',
+    'Esri_Radio_Id': 'string',
+    'Esri_created_user': 'string',
+    'Esri_last_edited_user': 'string',
+    'Esri_Status': 'int',
+    'Esri_Install_Date': 'datetime',
+    'Esri_created_date': 'datetime',
+    'Esri_last_edited_date': 'datetime',
+    'Esri_X': 'float',
+    'Esri_Y': 'float'
+}
+
+# source_name keeps failures from an earlier run's load (ex. "Esri snapshot") apart from today's in the report
+def convert_naviline_to_proper_types(nv_load, source_name="Naviline"):
+    return convert_to_schema(nv_load, naviline_schema, source_name)
+
+def convert_nv_inventory_to_proper_types(nv_load, source_name="Naviline inventory"):
+    return convert_to_schema(nv_load, nv_inventory_schema, source_name)
+
+def convert_dm_to_proper_types(dm_load, source_name="Sensus"):
+    return convert_to_schema(dm_load, dm_schema, source_name)
+
+def convert_esri_to_proper_types(esri_load, source_name="Esri"):
+    return convert_to_schema(esri_load, esri_schema, source_name)
+
+def write_query_with_jaydebeapi(connection, sql_query, writer, fetch_size):
+    """
+    Runs a query through a jaydebeapi cursor, writing the header and then fetch_size rows at a time to writer.
+    """
+    curs = connection.cursor()
     try:
-
-        curs = nav_conn.cursor()
-        print(f"running query from {query_file}")
-        sql_query = read_sql_query(query_file)
         curs.execute(sql_query)
 
         # Get column names
         column_names = [desc[0] for desc in curs.description]
         #print(f"Festching Results: {column_names}")
-        # Fetch all results
-        results = curs.fetchall()
-
-        naviline_data_as_dicts = [dict(zip(column_names, row)) for row in results]
-        data_out = etl.fromdicts(naviline_data_as_dicts)
+        writer.writerow(column_names)
+        while True:
+            results = curs.fetchmany(fetch_size)
+            if not results:
+                break
+            writer.writerows(results)
+    finally:
         curs.close()
+
+# java.sql.Types codes of the columns write_query_with_jpype reads with a typed getter, anything else is read as a string
+jdbc_integer_types = {-6, 5, 4, -5}     # TINYINT, SMALLINT, INTEGER, BIGINT
+jdbc_float_types = {6, 7, 8}            # FLOAT, REAL, DOUBLE
+jdbc_decimal_types = {2, 3}             # NUMERIC, DECIMAL
+jdbc_date_type = 91
+jdbc_timestamp_type = 93
+
+def jdbc_column_reader(result_set, meta_data, column):
+    """
+    Picks the ResultSet getter for one column from its JDBC type: getLong for integers and whole number decimals,
+    getDouble for other numbers, getTimestamp/getDate for dates and getString for the rest.  The primitive getters
+    return 0 for NULL, so wasNull is checked after them, but only for columns the metadata says can be NULL.  
+    Param - result_set: (java ResultSet) The open result set  
+    Param - meta_data: (java ResultSetMetaData) Its metadata  
+    Param - column: (int) The 1-based column number  
+    Returns - A function that returns the column's value in the current row, None for NULL
+    """
+    column_type = meta_data.getColumnType(column)
+    if column_type in jdbc_integer_types or (column_type in jdbc_decimal_types and meta_data.getScale(column) == 0 and meta_data.getPrecision(column) <= 18):
+        getter = result_set.getLong
+    elif column_type in jdbc_float_types or column_type in jdbc_decimal_types:
+        getter = result_set.getDouble
+    elif column_type in (jdbc_date_type, jdbc_timestamp_type):
+        getter = result_set.getDate if column_type == jdbc_date_type else result_set.getTimestamp
+        length = 10 if column_type == jdbc_date_type else 19
+        def read_date():
+            value = getter(column)
+            # whole seconds, like jaydebeapi; convert_to_schema drops the fraction anyway
+            return None if value is None else str(value)[:length]
+        return read_date
+    else:
+        get_string = result_set.getString
+        return lambda: get_string(column)
+
+    if meta_data.isNullable(column) == 0:     # columnNoNulls
+        return lambda: getter(column)
+    was_null = result_set.wasNull
+    def read_nullable():
+        value = getter(column)
+        return None if was_null() else value
+    return read_nullable
+
+def write_query_with_jpype(connection, sql_query, writer, fetch_size):
+    """
+    Runs a query on the JDBC connection underneath jaydebeapi and reads the jt400 ResultSet directly through jpype,
+    writing the header and then fetch_size rows at a time to writer.  Each column gets the typed getter for its
+    JDBC type once (see jdbc_column_reader), and values are gathered into one buffer per column, so there is no
+    jaydebeapi converter lookup per cell and numbers never go through a Java string.  JDBC only hands out a row at
+    a time, so it is still one getter call per cell.
+    """
+    statement = connection.jconn.createStatement()
+    try:
+        statement.setFetchSize(fetch_size)
+        result_set = statement.executeQuery(sql_query)
+        meta_data = result_set.getMetaData()
+        columns = range(1, meta_data.getColumnCount() + 1)
+        writer.writerow([str(meta_data.getColumnLabel(i)) for i in columns])
+
+        readers = [jdbc_column_reader(result_set, meta_data, i) for i in columns]
+        buffers = [[] for reader in readers]
+        buffered = 0
+        while result_set.next():
+            for reader, buffer in zip(readers, buffers):
+                buffer.append(reader())
+            buffered += 1
+            if buffered >= fetch_size:
+                writer.writerows(zip(*buffers))
+                buffers = [[] for reader in readers]
+                buffered = 0
+        writer.writerows(zip(*buffers))
+        result_set.close()
+    finally:
+        statement.close()
+
+# Ways of pulling a naviline query result, picked with NAVILINE_EXTRACTOR in config.ini
+naviline_extractors = {
+    'jaydebeapi': write_query_with_jaydebeapi,
+    'jpype': write_query_with_jpype
+}
+
+def query_naviline_data(query_file, output_file, extractor_name=None):
+    """
+    Runs a naviline query and streams the result straight to a csv file, fetching NAVILINE_FETCH_SIZE rows at a
+    time, so memory stays flat no matter how many rows come back.  The query runs on a pooled connection; if it
+    fails the connection is dropped and the query is tried once more on a new one.  
+    Param - query_file: (string) The sql file to run  
+    Param - output_file: (string) The csv file to write the result to  
+    Param - extractor_name: (string) Key in naviline_extractors, defaults to NAVILINE_EXTRACTOR from config.ini (or jaydebeapi)  
+    Returns - A PETL dataview (view) that lazily re-reads the csv file
+    """
+    fetch_size = config.getint('Misc', 'NAVILINE_FETCH_SIZE', fallback=5000)
+    if extractor_name is None:
+        extractor_name = config.get('Misc', 'NAVILINE_EXTRACTOR', fallback='jaydebeapi')
+    try:
+        print(f"running query from {query_file} with {extractor_name}")
+        sql_query = read_sql_query(query_file)
+        for attempt in range(2):
+            connection = checkout_naviline_connection()
+            try:
+                with open(output_file, "w", newline='') as f:
+                    naviline_extractors[extractor_name](connection, sql_query, csv.writer(f), fetch_size)
+            except Exception as e:
+                discard_naviline_connection(connection)
+                if attempt == 1:
+                    raise
+                print(f"Naviline query failed, reconnecting and trying again: {e}")
+                continue
+            checkin_naviline_connection(connection)
+            break
         
     except Exception as e:
         print(f"Error: {e}")
         exit()
-    return data_out
+    return CountedSourceView(etl.fromcsv(output_file, errors='ignore'), os.path.basename(output_file))
+
+def benchmark_naviline_extractors():
+    """
+    Runs both naviline queries through every extractor in naviline_extractors, writing to {workdir}/benchmark/,
+    and outputs rows, seconds and rows per second for each to stat_output.  
+    Param - None  
+    Returns - None
+    """
+    benchmark_dir = os.path.join(workdir, 'benchmark')
+    os.makedirs(benchmark_dir, exist_ok=True)
+    for query_file in [naviline_query_file, naviline_inventory_query_file]:
+        for extractor_name in naviline_extractors:
+            output_file = os.path.join(benchmark_dir, f"{os.path.basename(os.path.splitext(query_file)[0])}_{extractor_name}.csv")
+            start = time.perf_counter()
+            with stage_timer(f"extract_{os.path.basename(os.path.splitext(query_file)[0])}_{extractor_name}") as timing:
+                row_count = etl.nrows(query_naviline_data(query_file, output_file, extractor_name))
+                timing['rows_out'] = row_count
+            seconds = time.perf_counter() - start
+            stat_output(f"Extract of {query_file} with {extractor_name}: {row_count} rows in {seconds:.1f} seconds ({row_count / seconds:.0f} rows/sec)")
     
 def load_naviline_data():
     """
-    Queries Naviline data and loads it into a petl struct 
+    Queries Naviline data into the initial naviline csv and loads it into a petl struct 
     Param - None  
-    Returns - None
+    Returns - A PETL dataview (view) with typed naviline data
     """
-    initial_nv_load = query_naviline_data(naviline_query_file)
-    initial_nv_load = convert_naviline_to_proper_types(initial_nv_load)
-    export_view_to_file(initial_nv_load, os.path.basename(os.path.splitext(input_nv)[0]))  # naviline file without the extension or folder
+    initial_nv_load = query_naviline_data(naviline_query_file, input_nv)
+    initial_nv_load = materialize(convert_naviline_to_proper_types(initial_nv_load))
+    write_columnar_snapshot(initial_nv_load, input_nv, naviline_schema)
+    stat_output(f"Number of rows in initial nv load: {etl.nrows(initial_nv_load)}")
     return initial_nv_load
 
 def load_naviline_inventory():
-    nv_inventory_load = query_naviline_data(naviline_inventory_query_file)
-    nv_inventory_load = convert_nv_inventory_to_proper_types(nv_inventory_load)
-    export_view_to_file(nv_inventory_load, os.path.basename(os.path.splitext(input_nv_inventory)[0]))
+    nv_inventory_load = query_naviline_data(naviline_inventory_query_file, input_nv_inventory)
+    nv_inventory_load = materialize(convert_nv_inventory_to_proper_types(nv_inventory_load))
+    write_columnar_snapshot(nv_inventory_load, input_nv_inventory, nv_inventory_schema)
+    stat_output(f"Number of rows in initial nv inventory load: {etl.nrows(nv_inventory_load)}")
     return nv_inventory_load
 
 # Load Naviline service point data
 def load_naviline_data_from_file():
     """
-    Loads naviline data from a CSV file  
+    Loads naviline data from its typed snapshot, or from a CSV file when there isn't one  
     Param - None  
     Returns - A PETL dataview (view) with naviline data from a CSV file.
     """
-    initial_nv_load = etl.fromcsv(input_nv,errors='ignore') # headers=['NAVILINE_SERVICE_ID','METERNUMBER','LOCATIONID','LOCATION_ON_PROPERTY','SERVICETYPE','METER_SIZE','SEQNUMB','ADDRESS','CYCLENUMB','INSTALLDATE','CYCLEROUTE','METER_MAKE','RADIO','REGISTER','JURISDICTION','RATE_CLASS','CUSTNAME','MASKEDMETERNUMB']
-    # reading a csv, everything comes in as a string.  Anything that is not a string should be converted (int, date), if those values are blank, the should be converted to None
+    initial_nv_load = read_columnar_snapshot(input_nv)
+    if initial_nv_load is None:
+        initial_nv_load = CountedSourceView(etl.fromcsv(input_nv,errors='ignore'), os.path.basename(input_nv)) # headers=['NAVILINE_SERVICE_ID','METERNUMBER','LOCATIONID','LOCATION_ON_PROPERTY','SERVICETYPE','METER_SIZE','SEQNUMB','ADDRESS','CYCLENUMB','INSTALLDATE','CYCLEROUTE','METER_MAKE','RADIO','REGISTER','JURISDICTION','RATE_CLASS','CUSTNAME','MASKEDMETERNUMB']
+        # reading a csv, everything comes in as a string.  Anything that is not a string should be converted (int, date), if those values are blank, the should be converted to None
 
-    initial_nv_load =convert_naviline_to_proper_types(initial_nv_load)
+        initial_nv_load = materialize(convert_naviline_to_proper_types(initial_nv_load))
+        write_columnar_snapshot(initial_nv_load, input_nv, naviline_schema)
     stat_output(f"Number of rows in initial nv load: {etl.nrows(initial_nv_load)}")
     return initial_nv_load
 
 def load_naviline_inventory_from_file():
-    nv_inventory_load = etl.fromcsv(input_nv_inventory,errors='ignore')
-    nv_inventory_load = convert_nv_inventory_to_proper_types(nv_inventory_load)
+    nv_inventory_load = read_columnar_snapshot(input_nv_inventory)
+    if nv_inventory_load is None:
+        nv_inventory_load = CountedSourceView(etl.fromcsv(input_nv_inventory,errors='ignore'), os.path.basename(input_nv_inventory))
+        nv_inventory_load = materialize(convert_nv_inventory_to_proper_types(nv_inventory_load))
+        write_columnar_snapshot(nv_inventory_load, input_nv_inventory, nv_inventory_schema)
     stat_output(f"Number of rows in initial nv inventory load: {etl.nrows(nv_inventory_load)}")
     return nv_inventory_load
 
-def transfer_sensus_data():
+def get_box_token():
     """
-    Gets the current sensus meter file from box and transfers it to the local directory
-    Param - None
+    Returns a Box access token, requesting a new one only when there's no cached token or it's within a minute of
+    expiring.  
+    Returns - The access token (string)
     """
+    global box_token
+    global box_token_expires
+    if box_token is not None and time.monotonic() < box_token_expires:
+        return box_token
+
     BOX_CLIENT_ID = config['Credentials']['BOX_CLIENT_ID']
     BOX_CLIENT_SECRET = config['Credentials']['BOX_CLIENT_SECRET']
     # Choose ONE subject to authenticate as:
     BOX_SUBJECT_TYPE = "enterprise"     # "enterprise" to use the app's Service Account, or "user" to impersonate a managed user
     BOX_ENTERPRISE_ID = config['Credentials']['BOX_ENTERPRISE_ID']
-    FILE_ID = config['Misc']['BOX_FILE_ID_METER_DATA']
+    BOX_API_URL = config.get('Misc', 'BOX_API_URL', fallback="https://api.box.com")
 
     token_resp = requests.post(
-    "https://api.box.com/oauth2/token",
+    f"{BOX_API_URL}/oauth2/token",
         data={
             "grant_type": "client_credentials",
             "client_id": BOX_CLIENT_ID,
@@ -314,10 +850,78 @@ def transfer_sensus_data():
         timeout=30,
     )
     token_resp.raise_for_status()
-    access_token = token_resp.json()["access_token"]
+    token = token_resp.json()
     #print (f"Access token: {access_token}")
+    box_token = token["access_token"]
+    box_token_expires = time.monotonic() + token.get("expires_in", 3600) - 60
+    return box_token
+
+def box_file_version(metadata):
+    """
+    The parts of Box file metadata that identify a version of the file's content
+    """
+    return (metadata.get('sha1'), (metadata.get('file_version') or {}).get('id'), metadata.get('size'))
+
+def find_unchanged_sensus_file(metadata):
+    """
+    Looks for a Sensus file with the same Box sha1, version and size as metadata: first the one already in the
+    workdir, then the one in the most recent earlier workdir.  Each Sensus file has the Box metadata it was
+    downloaded with next to it, in {name}.box.json.  
+    Param - metadata: (dict) The current Box metadata of the file  
+    Returns - The path of the matching Sensus file, or None
+    """
+    metadata_name = os.path.basename(os.path.splitext(input_dm)[0]) + '.box.json'
+    for metadata_path in [os.path.join(workdir, metadata_name), find_previous_workdir_file(metadata_name)]:
+        if metadata_path is None or not os.path.exists(metadata_path):
+            continue
+        sensus_path = os.path.join(os.path.dirname(metadata_path), os.path.basename(input_dm))
+        with open(metadata_path, "r") as f:
+            stored_metadata = json.load(f)
+        if metadata.get('sha1') and box_file_version(stored_metadata) == box_file_version(metadata) and os.path.exists(sensus_path) and os.path.getsize(sensus_path) == metadata.get('size'):
+            return sensus_path
+    return None
+
+def transfer_sensus_data():
+    """
+    Gets the current sensus meter file from box and transfers it to the local directory.  The file's Box metadata
+    is checked first: if the file in the workdir, or in the previous workdir, has the same sha1 and version, that
+    one is used (hard linked, or copied where linking isn't possible) instead of downloading it again.  Whether the
+    file was downloaded or reused goes to the summary.
+    Param - None
+    """
+    FILE_ID = config['Misc']['BOX_FILE_ID_METER_DATA']
+    BOX_API_URL = config.get('Misc', 'BOX_API_URL', fallback="https://api.box.com")
+    access_token = get_box_token()
+
+    # 1) Check the file's current version
+    metadata_resp = requests.get(
+        f"{BOX_API_URL}/2.0/files/{FILE_ID}",
+        params={"fields": "sha1,size,modified_at,file_version"},
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=30,
+    )
+    metadata_resp.raise_for_status()
+    metadata = metadata_resp.json()
+    metadata_path = os.path.splitext(input_dm)[0] + '.box.json'
+
+    unchanged_file = find_unchanged_sensus_file(metadata)
+    if unchanged_file is not None:
+        if os.path.abspath(unchanged_file) != os.path.abspath(input_dm):
+            # A typed snapshot in the workdir was made from the file being replaced
+            for replaced_path in [input_dm, columnar_snapshot_path(input_dm)]:
+                if os.path.exists(replaced_path):
+                    os.remove(replaced_path)
+            try:
+                os.link(unchanged_file, input_dm)
+            except OSError:
+                shutil.copy2(unchanged_file, input_dm)
+            with open(metadata_path, "w") as f:
+                json.dump(metadata, f)
+        stat_output(f"Sensus input: reused {unchanged_file}, unchanged in Box since it was downloaded (modified {metadata.get('modified_at')}, sha1 {metadata.get('sha1')})")
+        return
+
     # 2) Download the file content by ID and write to disk
-    download_url = f"https://api.box.com/2.0/files/{FILE_ID}/content"
+    download_url = f"{BOX_API_URL}/2.0/files/{FILE_ID}/content"
     with requests.get(
         download_url,
         headers={"Authorization": f"Bearer {access_token}"},
@@ -326,102 +930,510 @@ def transfer_sensus_data():
         timeout=60,
     ) as r:
         r.raise_for_status()
-        with open(input_dm, "wb") as f:
+        # Written under a temporary name and moved into place, so a link to an earlier run's file is replaced
+        # rather than written through, and a failed download never looks like a complete one
+        with open(input_dm + '.part', "wb") as f:
             for chunk in r.iter_content(chunk_size=1024 * 1024):
                 if chunk:
                     f.write(chunk)
+    os.replace(input_dm + '.part', input_dm)
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f)
+    stat_output(f"Sensus input: fresh download (modified {metadata.get('modified_at')}, sha1 {metadata.get('sha1')})")
 
 # Load Sensus meter data with explicit header
+# Columns of the Sensus Box file, which has no header row
+sensus_file_header = ['RecordType','RecordVersion','SenderID','SenderCustomerID','SensusRadioId','SensusMeterNumber','TimeStamp','RecordId','OperationType','Purpose','Comment','Commodity','Activity','EquipmentType','Manufacturer','Model','SensusOtherMeterNumber','Identifier','DateOfPurchase','SensusDateOfInstallation','Owner','Count','Field1','Value1','Field2','Value2','Field3','Value3','Field4','SensusLatitude','Field5','SensusLongitude','Field6','Value6','Field7','Value7','Field8','Value8','Field9','Value9']
+# Columns of the file that are loaded, in load order, and the names they're loaded as
+sensus_loaded_columns = ['SensusRadioId','SensusMeterNumber','Value3','SensusLongitude','SensusLatitude']
+sensus_loaded_names = ['SensusRadioId','SensusMeterNumber','SensusDateOfInstallation','SensusLongitude','SensusLatitude']
+
+def read_sensus_with_petl(file_path):
+    """
+    Reads the Sensus file with etl.fromcsv, cutting it down to the loaded columns, and converts them.  This is
+    the reader used before read_sensus_with_mmap (SENSUS_READER = petl).  
+    Param - file_path: (string) The Sensus csv  
+    Returns - A materialized PETL table with typed sensus data
+    """
+    dm_load = etl.rename(etl.cut(CountedSourceView(etl.fromcsv(file_path,header=sensus_file_header), os.path.basename(file_path)),*sensus_loaded_columns),dict(zip(sensus_loaded_columns, sensus_loaded_names)))
+    # reading a csv, everything comes in as a string.  Anything that is not a string should be converted (int, date), if those values are blank, the should be converted to None
+    return materialize(convert_dm_to_proper_types(dm_load))
+
+def read_sensus_with_mmap(file_path):
+    """
+    Reads the Sensus file through a memory map in a single pass, splitting out only the loaded columns and
+    converting each value as it's read.  Records with quotes are handed to the csv module (they may hold commas or
+    line breaks); everything else is split on commas directly.  Returns the same table as read_sensus_with_petl.  
+    Param - file_path: (string) The Sensus csv  
+    Returns - A materialized PETL table with typed sensus data
+    """
+    positions = [sensus_file_header.index(column) for column in sensus_loaded_columns]
+    conversions = [make_counted_conversion("Sensus", name, dm_schema[name]) for name in sensus_loaded_names]
+    rows = [tuple(sensus_loaded_names)]
+    source_name = os.path.basename(file_path)
+    source_passes[source_name] = source_passes.get(source_name, 0) + 1
+    if os.path.getsize(file_path) == 0:
+        return etl.wrap(rows)
+
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b''):
+            if b'"' in line:
+                while line.count(b'"') % 2 == 1:
+                    next_line = mm.readline()
+                    if not next_line:
+                        break
+                    line += next_line
+                fields = next(csv.reader(io.StringIO(line.decode('utf-8', 'replace'), newline='')), [])
+            else:
+                fields = line.rstrip(b'\r\n').decode('utf-8', 'replace').split(',')
+            rows.append(tuple(conversion(fields[position]) if position < len(fields) else None for position, conversion in zip(positions, conversions)))
+    return etl.wrap(rows)
+
+def benchmark_sensus_readers(row_count):
+    """
+    Writes a synthetic Sensus file of row_count rows to {workdir}/benchmark/, reads it with read_sensus_with_petl
+    and read_sensus_with_mmap, checks they return the same table and outputs the seconds and rows per second of
+    each to stat_output.  
+    Param - row_count: (int) Number of rows in the synthetic file  
+    Returns - None
+    """
+    benchmark_dir = os.path.join(workdir, 'benchmark')
+    os.makedirs(benchmark_dir, exist_ok=True)
+    file_path = os.path.join(benchmark_dir, 'synthetic_sensus_load.csv')
+    generator = random.Random(0)
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i in range(row_count):
+            row = [f"{column}{i % 7}" for column in sensus_file_header]
+            row[sensus_file_header.index('SensusRadioId')] = str(100000000 + i)
+            row[sensus_file_header.index('SensusMeterNumber')] = str(generator.randint(10000000, 99999999))
+            row[sensus_file_header.index('Value3')] = f"{generator.randint(2000, 2024)}-{generator.randint(1, 12):02d}-{generator.randint(1, 28):02d}" if i % 50 else ""
+            row[sensus_file_header.index('SensusLatitude')] = f"{generator.uniform(35.7, 35.85):.6f}"
+            row[sensus_file_header.index('SensusLongitude')] = f"{generator.uniform(-78.9, -78.7):.6f}"
+            row[sensus_file_header.index('Comment')] = "moved, see notes" if i % 1000 == 0 else ""
+            writer.writerow(row)
+
+    tables = {}
+    for reader_name, reader in [('petl', read_sensus_with_petl), ('mmap', read_sensus_with_mmap)]:
+        start = time.perf_counter()
+        tables[reader_name] = reader(file_path)
+        seconds = time.perf_counter() - start
+        stat_output(f"Sensus read of {row_count} rows with {reader_name}: {seconds:.2f} seconds ({row_count / seconds:.0f} rows/sec)")
+    stat_output(f"Sensus readers returned the same table: {list(iter(tables['petl'])) == list(iter(tables['mmap']))}")
+
 def load_sensus_data():
     """
-    Loads sensus data from a CSV file  
+    Loads sensus data from its typed snapshot, or from the Sensus file with the reader picked by SENSUS_READER
+    (mmap or petl) when there isn't one  
     Param - None  
     Returns - A PETL dataview (view) with sensus data from a CSV file.
     """
-    initial_dm_load = etl.rename(etl.cut(etl.fromcsv(input_dm,header=['RecordType','RecordVersion','SenderID','SenderCustomerID','SensusRadioId','SensusMeterNumber','TimeStamp','RecordId','OperationType','Purpose','Comment','Commodity','Activity','EquipmentType','Manufacturer','Model','SensusOtherMeterNumber','Identifier','DateOfPurchase','SensusDateOfInstallation','Owner','Count','Field1','Value1','Field2','Value2','Field3','Value3','Field4','SensusLatitude','Field5','SensusLongitude','Field6','Value6','Field7','Value7','Field8','Value8','Field9','Value9']),'SensusRadioId','SensusMeterNumber','Value3','SensusLongitude','SensusLatitude'),{'Value3':'SensusDateOfInstallation'})
-
-    # reading a csv, everything comes in as a string.  Anything that is not a string should be converted (int, date), if those values are blank, the should be converted to None
-    initial_dm_load = convert_dm_to_proper_types(initial_dm_load)
+    initial_dm_load = read_columnar_snapshot(input_dm)
+    if initial_dm_load is None:
+        if config.get('Misc', 'SENSUS_READER', fallback='mmap') == 'petl':
+            initial_dm_load = read_sensus_with_petl(input_dm)
+        else:
+            initial_dm_load = read_sensus_with_mmap(input_dm)
+        write_columnar_snapshot(initial_dm_load, input_dm, dm_schema)
     stat_output(f"Number of rows in initial DM load: {etl.nrows(initial_dm_load)}")
     return initial_dm_load
 
 # Load and rename ESRI layer columns to avoid collisions
+# Esri layer fields are renamed on load to avoid collisions with the naviline fields
+esri_field_renames = {
+    'OBJECTID':'Esri_OBJECTID',
+    'Naviline_Service_Id':'Esri_Naviline_Service_Id',
+    'Meter_Number':'Esri_Meter_Number',
+    'Location_Id':'Esri_Location_Id',
+    'Cycle':'Esri_Cycle',
+    'Sequence':'Esri_Sequence',
+    'Location_On_Property':'Esri_Location_On_Property',
+    'Jurisdiction':'Esri_Jurisdiction',
+    'ServiceType':'Esri_ServiceType',
+    'Meter_Size':'Esri_Meter_Size',
+    'Rate_Class':'Esri_Rate_Class',
+    'Address':'Esri_Address',
+    'Install_Date':'Esri_Install_Date',
+    'Meter_Make':'Esri_Meter_Make',
+    'Customer_Name':'Esri_Customer_Name',
+    'Register':'Esri_Register',
+    'Radio_Id':'Esri_Radio_Id',
+    'created_user':'Esri_created_user',
+    'created_date':'Esri_created_date',
+    'last_edited_user':'Esri_last_edited_user',
+    'last_edited_date':'Esri_last_edited_date',
+    'Status':'Esri_Status',
+    'X':'Esri_X',
+    'Y':'Esri_Y'
+}
+
+def esri_cursor_rows(where_clause):
+    """
+    Generator over a SearchCursor on the meters feature server: the header first, then each row with the Shape
+    split into X and Y.
+    """
+    shape_index = esri_meter_fields.index("Shape")
+    yield tuple(field_name for field_name in esri_meter_fields if field_name != "Shape") + ("X", "Y")
+    for row in arcpy.da.SearchCursor(meters_feature_server, esri_meter_fields, where_clause):
+        shape = row[shape_index]
+        yield tuple(value for i, value in enumerate(row) if i != shape_index) + (shape[0], shape[1])
+
+def read_esri_rows(where_clause=None):
+    """
+    Reads rows from the meters feature server with a SearchCursor, streaming them through the rename
+    (esri_field_renames) and type conversion straight into a materialized table.  
+    Param - where_clause: (string) Optional where clause limiting the rows read  
+    Returns - A materialized PETL table with the rows, typed like initial_esri_load
+    """
+    # The cursor generator can only be read once, which is all materialize does
+    esri_rows = CountedSourceView(etl.wrap(esri_cursor_rows(where_clause)), "Esri meters feature server")
+    esri_rows = etl.rename(esri_rows, esri_field_renames)
+    return materialize(convert_esri_to_proper_types(esri_rows))
+
+def read_esri_layer():
+    """
+    Reads the whole meters layer, split into ESRI_READ_PARTITIONS OBJECTID ranges of about the same number of rows
+    that are read ESRI_READ_WORKERS at a time.  Rows/sec for each partition go to stat_output so the partition
+    count can be tuned.  
+    Param - None  
+    Returns - A materialized PETL table with every row, typed like initial_esri_load
+    """
+    partitions = config.getint('Misc', 'ESRI_READ_PARTITIONS', fallback=8)
+    workers = config.getint('Misc', 'ESRI_READ_WORKERS', fallback=4)
+
+    object_ids = sorted(row[0] for row in arcpy.da.SearchCursor(meters_feature_server, ["OBJECTID"]))
+    if not object_ids:
+        return read_esri_rows()
+    partition_size = -(-len(object_ids) // partitions)
+    where_clauses = []
+    for i in range(0, len(object_ids), partition_size):
+        if i + partition_size < len(object_ids):
+            where_clauses.append(f"OBJECTID >= {object_ids[i]} AND OBJECTID < {object_ids[i + partition_size]}")
+        else:
+            where_clauses.append(f"OBJECTID >= {object_ids[i]}")   # open ended, so rows added since the id scan aren't missed
+
+    def read_partition(where_clause):
+        start = time.perf_counter()
+        partition_rows = read_esri_rows(where_clause)
+        seconds = time.perf_counter() - start
+        row_count = etl.nrows(partition_rows)
+        stat_output(f"Esri partition {where_clause}: {row_count} rows in {seconds:.1f} seconds ({row_count / max(seconds, 0.001):.0f} rows/sec)")
+        return partition_rows
+
+    with ThreadPoolExecutor(max_workers=workers) as read_pool:
+        partition_tables = list(read_pool.map(read_partition, where_clauses))
+
+    meter_data = [tuple(etl.header(partition_tables[0]))]
+    for partition_rows in partition_tables:
+        meter_data.extend(etl.data(partition_rows))
+    return etl.wrap(meter_data)
+
+def esri_full_refresh_due():
+    """
+    Checks whether the Esri layer should be read in full today: when ESRI_FULL_REFRESH_DAYS or more days have
+    passed since the date in {output_base}/esri_last_full_refresh.txt, or that file doesn't exist.
+    """
+    refresh_days = config.getint('Misc', 'ESRI_FULL_REFRESH_DAYS', fallback=7)
+    marker_path = os.path.join(output_base, 'esri_last_full_refresh.txt')
+    if not os.path.exists(marker_path):
+        return True
+    with open(marker_path, "r") as f:
+        last_refresh = datetime.strptime(f.read().strip(), "%Y%m%d").date()
+    return (date.today() - last_refresh).days >= refresh_days
+
+def record_esri_full_refresh():
+    with open(os.path.join(output_base, 'esri_last_full_refresh.txt'), "w") as f:
+        f.write(date.today().strftime("%Y%m%d"))
+
+def find_previous_workdir_file(file_name, required_file=None):
+    """
+    Finds file_name in the most recent dated (YYYYMMDD) folder of output_base other than the current workdir.  
+    Param - file_name: (string) The name of the file to look for  
+    Param - required_file: (string) If given, only folders that also have this file are considered  
+    Returns - The path of the file, or None if no earlier run has one
+    """
+    dated_folders = sorted((folder for folder in os.listdir(output_base) if folder.isdigit() and len(folder) == 8), reverse=True)
+    for folder in dated_folders:
+        folder_path = os.path.join(output_base, folder)
+        if os.path.abspath(folder_path) == os.path.abspath(workdir):
+            continue
+        file_path = os.path.join(folder_path, file_name)
+        if os.path.exists(file_path) and (required_file is None or os.path.exists(os.path.join(folder_path, required_file))):
+            return file_path
+    return None
+
+def edits_applied_marker():
+    return workdir + edits_applied_marker_name
+
+def write_edits_applied_marker(add_count, edit_count):
+    """
+    Records in the workdir that this run's Esri edits all went in, so its loads can be the baseline of a later
+    --delta run.  
+    Param - add_count: (int) Number of adds in the run  
+    Param - edit_count: (int) Number of updates and removes in the run
+    """
+    with open(edits_applied_marker(), "w") as f:
+        json.dump({'finished': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'adds': add_count, 'edits': edit_count}, f)
+
+def load_esri_incrementally(snapshot_file):
+    """
+    Rebuilds the current Esri layer from an earlier run's initial_esri_load and only the rows that have changed
+    since.  Rows created or edited at or after the newest created_date/last_edited_date in the snapshot are read
+    from the server and replace their snapshot rows, and snapshot rows whose OBJECTID is no longer on the server
+    are dropped.  
+    Param - snapshot_file: (string) The initial_esri_load csv of an earlier run  
+    Returns - A materialized PETL table like the one a full read returns, or None if the snapshot has no dates to go on
+    """
+    snapshot = read_columnar_snapshot(snapshot_file)
+    if snapshot is None:
+        snapshot = materialize(convert_esri_to_proper_types(CountedSourceView(etl.fromcsv(snapshot_file), "Esri snapshot"), "Esri snapshot"))
+    edit_dates = [edit_date for edit_date in etl.values(snapshot, 'Esri_last_edited_date') if edit_date is not None]
+    edit_dates += [edit_date for edit_date in etl.values(snapshot, 'Esri_created_date') if edit_date is not None]
+    if not edit_dates:
+        return None
+    watermark = max(edit_dates).strftime("%Y-%m-%d %H:%M:%S")
+
+    # >= since the snapshot dates are truncated to the second, rows read again simply replace their snapshot copy
+    changed_rows = read_esri_rows(f"last_edited_date >= TIMESTAMP '{watermark}' OR created_date >= TIMESTAMP '{watermark}'")
+    changed_ids = set(etl.values(changed_rows, 'Esri_OBJECTID'))
+    live_ids = set(row[0] for row in arcpy.da.SearchCursor(meters_feature_server, ["OBJECTID"]))
+
+    unchanged_rows = etl.select(snapshot, lambda rec: rec.Esri_OBJECTID in live_ids and rec.Esri_OBJECTID not in changed_ids)
+    merged = materialize(etl.cat(unchanged_rows, changed_rows))
+
+    stat_output(f"Esri load: incremental from {snapshot_file} (changes since {watermark})")
+    stat_output(f"Number of rows in Esri snapshot: {etl.nrows(snapshot)}")
+    stat_output(f"Number of Esri rows created or edited since snapshot: {len(changed_ids)}")
+    stat_output(f"Number of snapshot rows no longer in Esri: {len(set(etl.values(snapshot, 'Esri_OBJECTID')) - live_ids)}")
+    return merged
+
 def load_esri_data():
     """
-    Loads current ESRI data from ESRI using arcpy.  
+    Loads current ESRI data from ESRI using arcpy.  With ESRI_INCREMENTAL = true in config.ini, the previous run's
+    initial_esri_load is used as a snapshot and only the changes since are read (see load_esri_incrementally),
+    with a full read every ESRI_FULL_REFRESH_DAYS days.  
     Param - None  
     Returns - A PETL dataview (view) with current ESRI data, with fields renamed to avoid collisions.
     """
-    meter_data = [row for row in arcpy.da.SearchCursor(meters_feature_server, esri_meter_fields)]
-
-    #print(f"--- Loaded {len(meter_data)} rows from ESRI meters feature server ---")
-    #meter_data = meter_data[:10]
-
-    meter_data_as_dicts = [dict(zip(esri_meter_fields, row)) for row in meter_data]
-    for row in meter_data_as_dicts:
-        row["X"] = row["Shape"][0]
-        row["Y"] = row["Shape"][1]
-        del row["Shape"]
-
-    initial_esri_load = etl.fromdicts(meter_data_as_dicts)
-
-    #print(initial_esri_load)
-
-    initial_esri_load = etl.rename(initial_esri_load,{
-        'OBJECTID':'Esri_OBJECTID',
-        'Naviline_Service_Id':'Esri_Naviline_Service_Id',
-        'Meter_Number':'Esri_Meter_Number',
-        'Location_Id':'Esri_Location_Id',
-        'Cycle':'Esri_Cycle',
-        'Sequence':'Esri_Sequence',
-        'Location_On_Property':'Esri_Location_On_Property',
-        'Jurisdiction':'Esri_Jurisdiction',
-        'ServiceType':'Esri_ServiceType',
-        'Meter_Size':'Esri_Meter_Size',
-        'Rate_Class':'Esri_Rate_Class',
-        'Address':'Esri_Address',
-        'Install_Date':'Esri_Install_Date',
-        'Meter_Make':'Esri_Meter_Make',
-        'Customer_Name':'Esri_Customer_Name',
-        'Register':'Esri_Register',
-        'Radio_Id':'Esri_Radio_Id',
-        'created_user':'Esri_created_user',
-        'created_date':'Esri_created_date',
-        'last_edited_user':'Esri_last_edited_user',
-        'last_edited_date':'Esri_last_edited_date',
-        'Status':'Esri_Status',
-        'X':'Esri_X',
-        'Y':'Esri_Y'
-    })
-    initial_esri_load = convert_esri_to_proper_types(initial_esri_load)
-    export_view_to_file(initial_esri_load, os.path.basename(os.path.splitext(input_esri)[0]))  # esri file without the extension or folder
+    initial_esri_load = None
+    if config.getboolean('Misc', 'ESRI_INCREMENTAL', fallback=False) and not esri_full_refresh_due():
+        snapshot_file = find_previous_workdir_file(os.path.basename(input_esri))
+        if snapshot_file is not None:
+            initial_esri_load = load_esri_incrementally(snapshot_file)
+
+    if initial_esri_load is None:
+        initial_esri_load = read_esri_layer()
+        record_esri_full_refresh()
+        stat_output("Esri load: full refresh")
+
+    # written here rather than on the export pool so the csv is never newer than its typed snapshot
+    write_view_to_file(initial_esri_load, os.path.basename(os.path.splitext(input_esri)[0]))  # esri file without the extension or folder
+    write_columnar_snapshot(initial_esri_load, input_esri, esri_schema)
 
     return initial_esri_load
 
 def load_esri_data_from_file():
-    initial_esri_load = etl.fromcsv(input_esri)
+    initial_esri_load = read_columnar_snapshot(input_esri)
+    if initial_esri_load is None:
+        initial_esri_load = CountedSourceView(etl.fromcsv(input_esri), os.path.basename(input_esri))
+        # reading a csv, everything comes in as a string.  Anything that is not a string should be converted (int, date), if those values are blank, the should be converted to None
+        initial_esri_load = materialize(convert_esri_to_proper_types(initial_esri_load))
+        write_columnar_snapshot(initial_esri_load, input_esri, esri_schema)
     stat_output(f"Number of rows in initial_esri_load: {etl.nrows(initial_esri_load)}")
-    # reading a csv, everything comes in as a string.  Anything that is not a string should be converted (int, date), if those values are blank, the should be converted to None
-    initial_esri_load = convert_esri_to_proper_types(initial_esri_load)
     return initial_esri_load
 
+def fetch_all_sources():
+    '''
+    Fetches Naviline, Sensus (from Box) and Esri at the same time, since they are three independent systems and
+    the fetch would otherwise take the sum of their latencies.  The two Naviline queries run at the same time too,
+    each on its own pooled connection.  The time each source took is written to the summary.
+    If a source fails, anything not yet started is cancelled, the sources already in flight are allowed to finish,
+    and the run exits.  
+    Param - None  
+    Returns - initial_nv_load, initial_nv_inventory_load, initial_dm_load, initial_esri_load
+    '''
+    def fetch_naviline():
+        return run_timed('naviline_load', load_naviline_data)
+
+    def fetch_naviline_inventory():
+        return run_timed('naviline_inventory_load', load_naviline_inventory)
+
+    def fetch_sensus():
+        run_timed('box_download', transfer_sensus_data)
+        return run_timed('sensus_load', load_sensus_data)
+
+    def fetch_esri():
+        return run_timed('esri_load', load_esri_data)
+
+    fetchers = {'Naviline': fetch_naviline, 'Naviline inventory': fetch_naviline_inventory, 'Sensus': fetch_sensus, 'Esri': fetch_esri}
+    fetch_times = {}
+
+    def timed_fetch(source_name):
+        start = time.perf_counter()
+        try:
+            return fetchers[source_name]()
+        finally:
+            fetch_times[source_name] = time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(fetchers)) as fetch_pool:
+        futures = {source_name: fetch_pool.submit(timed_fetch, source_name) for source_name in fetchers}
+        wait(futures.values(), return_when=FIRST_EXCEPTION)
+        for future in futures.values():
+            future.cancel()     # no-op for fetches that are running or finished
+
+    failed_sources = []
+    for source_name, future in futures.items():
+        if future.cancelled():
+            stat_output(f"Fetch of {source_name} cancelled")
+        elif future.exception() is not None:
+            failed_sources.append(source_name)
+            stat_output(f"Fetch of {source_name} failed after {fetch_times[source_name]:.1f} seconds: {future.exception()!r}")
+        else:
+            stat_output(f"Fetch time for {source_name}: {fetch_times[source_name]:.1f} seconds")
+
+    if failed_sources:
+        print(f"Error: could not fetch {', '.join(failed_sources)}")
+        exit()
+
+    return futures['Naviline'].result(), futures['Naviline inventory'].result(), futures['Sensus'].result(), futures['Esri'].result()
+
+# --- INSTRUMENTATION ---
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of the process so far in MB, from the resource module where there is one and
+    psutil otherwise (Windows).  Returns None if neither is available.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024, 1)  # bytes on macOS, KB elsewhere
+    except ImportError:
+        pass
+    try:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return round(getattr(memory, 'peak_wset', memory.rss) / 1024 / 1024, 1)
+    except ImportError:
+        return None
+
+def count_rows(value):
+    """
+    Counts the rows in a table, the entries in a dict, list or set, or the total of those in a tuple of them.
+    Returns None for anything else.
+    """
+    if isinstance(value, Table):
+        return etl.nrows(value)
+    if isinstance(value, tuple):
+        counts = [count_rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    if isinstance(value, (dict, list, set)):
+        return len(value)
+    return None
+
+@contextmanager
+def stage_timer(stage_name, rows_in=None):
+    """
+    Times the block it wraps and records the wall time, rows in, rows out and peak RSS of the process to
+    stat_output and stage_timings.  The block sets timing['rows_out'] on the dict it is given.  Peak RSS is for the
+    whole process, so blocks that run at the same time (the fetch threads) share it.  stage_timings.json is
+    rewritten as each block finishes, so a run that fails still leaves the timings up to and including the failed
+    block, which also gets an 'error'.  
+    Param - stage_name: (string) The name to record the block under  
+    Param - rows_in: (int) Rows going into the block, if known
+    """
+    timing = {'stage': stage_name, 'rows_in': rows_in, 'rows_out': None}
+    start = time.perf_counter()
+    try:
+        yield timing
+    except BaseException as e:     # SystemExit too, the pipeline exit()s on fatal errors
+        timing['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        timing['seconds'] = round(time.perf_counter() - start, 3)
+        timing['peak_rss_mb'] = peak_rss_mb()
+        with stage_timings_lock:
+            stage_timings.append(timing)
+            write_stage_timings()
+        stat_output(f"Stage {stage_name}: {timing['seconds']:.1f} seconds, rows in {timing['rows_in']}, rows out {timing['rows_out']}, peak RSS {timing['peak_rss_mb']} MB")
+
+def run_timed(stage_name, function, *args):
+    """
+    Calls function(*args) inside a stage_timer, counting rows in from the arguments and rows out from the result
+    with count_rows.  
+    Param - stage_name: (string) The name to record the call under  
+    Param - function: (function) The function to call  
+    Returns - What the function returns
+    """
+    with stage_timer(stage_name, count_rows(tuple(args))) as timing:
+        result = function(*args)
+        timing['rows_out'] = count_rows(result)
+    return result
+
+def write_stage_timings():
+    # Called with stage_timings_lock held, or before any stage has started
+    with open(os.path.join(workdir, 'stage_timings.json'), "w") as f:
+        json.dump(stage_timings, f, indent=2)
+
 # --- Data Quality Checks and Filtering ---
 
-def export_view_to_file(view, file_name):
-    ''' 
-    Outputs the file name and number of rows to stat_output, then creates a CSV of the view with a provided file name.  
-    Param - view: (view) The petl view to export  
-    Param - file_name: (string) The name of the file to save. The file will be saved in {workdir}/{file_name}.csv
+def open_export_file(file_name):
+    '''
+    Opens {workdir}/{file_name}.csv for writing, creating the directory if it doesn't exist.  
+    Param - file_name: (string) The name of the file to open, relative to the workdir and without the extension  
+    Returns - An open file object ready to hand to csv.writer
     '''
-    stat_output(f"Number of rows in {file_name}: {etl.nrows(view)}")
-
     file_path = os.path.join(workdir, f"{file_name}.csv")
         
     # Create the directory if it doesn't exist
     dir_path = os.path.dirname(file_path)
     os.makedirs(dir_path, exist_ok=True)
 
-    etl.tocsv(view, file_path)
+    return open(file_path, "w", newline='')
+
+def write_view_to_file(view, file_name):
+    '''
+    Streams the view to {workdir}/{file_name}.csv in a single pass, counting rows as they are written, then
+    outputs the file name and number of rows to stat_output.  
+    Param - view: (view) The petl view to export  
+    Param - file_name: (string) The name of the file to save
+    '''
+    row_count = 0
+    with open_export_file(file_name) as f:
+        writer = csv.writer(f)
+        rows = iter(view)
+        header = next(rows, None)
+        if header is not None:
+            writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            row_count += 1
+
+    stat_output(f"Number of rows in {file_name}: {row_count}")
+
+def export_view_to_file(view, file_name):
+    ''' 
+    Creates a CSV of the view with a provided file name and outputs the file name and number of rows to stat_output.
+    If an export pool is running the export is queued on it, call wait_for_exports() before relying on the file.
+    The view is evaluated when the export runs, so it must not depend on anything the caller changes afterwards
+    (loop variables in lambdas, lists that are still being appended to).  
+    Param - view: (view) The petl view to export  
+    Param - file_name: (string) The name of the file to save. The file will be saved in {workdir}/{file_name}.csv
+    '''
+    if export_pool is None:
+        write_view_to_file(view, file_name)
+    else:
+        pending_exports.append(export_pool.submit(write_view_to_file, view, file_name))
+
+def wait_for_exports():
+    '''
+    Blocks until every queued export has been written.  Raises the first error hit by any of them.
+    '''
+    global pending_exports
+    exports = pending_exports
+    pending_exports = []
+    for export in exports:
+        export.result()
 
 
 def remove_if_duplicate(view, field_names, source_name):
@@ -458,8 +1470,9 @@ def remove_if_missing(view, field_names, source_name):
     modified_view = view
     for field_name in field_names:
         # 4. Identify duplicates
-        view_with_missing = etl.select(view, lambda rec: rec[field_name] == '' or rec[field_name] == None)
-        modified_view = etl.select(modified_view, lambda rec: rec[field_name] != '' and rec[field_name] != None)
+        # field_name is bound as a default, these selects are only evaluated after the loop (or on an export thread)
+        view_with_missing = etl.select(view, lambda rec, field_name=field_name: rec[field_name] == '' or rec[field_name] == None)
+        modified_view = etl.select(modified_view, lambda rec, field_name=field_name: rec[field_name] != '' and rec[field_name] != None)
 
         export_view_to_file(view_with_missing, f"{bad_data_subdir}missing_{field_name}_in_{source_name}")
 
@@ -492,7 +1505,7 @@ def clean_naviline_data(initial_nv_load):
     nv_clean = remove_if_duplicate(nv_clean, ["NAVILINE_SERVICE_ID"], "Naviline")
 
     nv_clean = remove_if_missing(nv_clean, ["RADIO", "REGISTER"], "Naviline")
-    nv_clean = remove_if_duplicate(nv_clean, ["RADIO", "REGISTER"], "Naviline")
+    nv_clean = materialize(remove_if_duplicate(nv_clean, ["RADIO", "REGISTER"], "Naviline"))
 
     stat_output(f"Number of joinable records in Naviline: {etl.nrows(nv_clean)}")
 
@@ -508,10 +1521,10 @@ def clean_sensus_data(initial_dm_load):
     wonky_coordinates = etl.select(initial_dm_load, lambda rec: rec['SensusLatitude'] == None or rec['SensusLongitude'] == None or rec['SensusLatitude'] > 35.91 or rec['SensusLatitude'] < 35.63 or rec['SensusLongitude'] > -78.72 or rec['SensusLongitude'] < -78.97)
     export_view_to_file(wonky_coordinates, f"{bad_data_subdir}data_suspect_coordinates_in_sensus")
 
-    dm_load = etl.unpack(etl.convert(etl.addfields(initial_dm_load,[("XY",'')]),'XY', convert_lat_long_to_state_plane, pass_row=True),'XY',['X','Y'])
+    dm_load = project_sensus_to_state_plane(initial_dm_load)
     
     dm_clean = remove_if_missing(dm_load, ["SensusRadioId", "SensusMeterNumber"], "Sensus")
-    dm_clean = remove_if_duplicate(dm_clean, ["SensusRadioId", "SensusMeterNumber"], "Sensus")
+    dm_clean = materialize(remove_if_duplicate(dm_clean, ["SensusRadioId", "SensusMeterNumber"], "Sensus"))
 
     stat_output(f"Number of joinable records in Sensus: {etl.nrows(dm_clean)}")
 
@@ -525,47 +1538,81 @@ def clean_esri_data(initial_esri_load):
     Return - A new view (view) with clean data.
     '''
     esri_clean = remove_if_missing(initial_esri_load, ['Esri_Naviline_Service_Id'], "esri")
-    esri_clean = remove_if_duplicate(esri_clean, ['Esri_Naviline_Service_Id'], "esri")
+    esri_clean = materialize(remove_if_duplicate(esri_clean, ['Esri_Naviline_Service_Id'], "esri"))
 
     stat_output(f"Number of joinable records in Esri: {etl.nrows(esri_clean)}")
 
     return esri_clean
 
-def categorize_meter_inventory(initial_inventory_load):
-    purged_in_warehouse = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'PURGED/ACTIVE_WAREHOUSE')
-    export_view_to_file(purged_in_warehouse, f"{bad_data_subdir}inventory_purged_meters_with_active_warehouse")
-    
-    purged_installed = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'PURGED/INSTALLED')
-    export_view_to_file(purged_installed, f"{bad_data_subdir}inventory_purged_meters_installed")
-
-    active_in_inactive_warehouse = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'ACTIVE/INACTIVE_WAREHOUSE')
-    export_view_to_file(active_in_inactive_warehouse, f"{bad_data_subdir}inventory_active_meters_in_inactive_warehouse")
+# DATA_ISSUE_TYPE values from complete_meter_inventory.sql and the file each category is written to
+inventory_categories = {
+    'PURGED/ACTIVE_WAREHOUSE': f"{bad_data_subdir}inventory_purged_meters_with_active_warehouse",
+    'PURGED/INSTALLED': f"{bad_data_subdir}inventory_purged_meters_installed",
+    'ACTIVE/INACTIVE_WAREHOUSE': f"{bad_data_subdir}inventory_active_meters_in_inactive_warehouse",
+    'ACTIVE/INSTALLED/WAREHOUSE': f"{bad_data_subdir}inventory_installed_meters_in_warehouse",
+    'NOT_INSTALLED/NO_WAREHOUSE': f"{bad_data_subdir}inventory_not_installed_no_warehouse",
+    'AUDIT_METER': f"{bad_data_subdir}inventory_audit_meters",
+    'CLEAN-ACTIVE/INSTALLED': f"{debug_data_subdir}inventory_installed_meters",
+    'CLEAN-ACTIVE/USED_INVENTORY': f"{debug_data_subdir}inventory_used_meters",
+    'CLEAN-PURGED/SCRAPPED_INVENTORY': f"{debug_data_subdir}inventory_discarded_meters",
+    'CLEAN-ACTIVE/NEW_INVENTORY': f"{debug_data_subdir}inventory_new_meters",
+    'UNKNOWN': f"{debug_data_subdir}inventory_uncategorized"
+}
+unrecognized_inventory_file = f"{bad_data_subdir}inventory_unrecognized_data_issue_type"
 
-    installed_and_warehouse = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'ACTIVE/INSTALLED/WAREHOUSE')
-    export_view_to_file(installed_and_warehouse, f"{bad_data_subdir}inventory_installed_meters_in_warehouse")
-
-    not_installed_no_warehouse = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'NOT_INSTALLED/NO_WAREHOUSE')
-    export_view_to_file(not_installed_no_warehouse, f"{bad_data_subdir}inventory_not_installed_no_warehouse")
+def categorize_meter_inventory(initial_inventory_load):
+    '''
+    Splits the inventory into one csv per DATA_ISSUE_TYPE (see inventory_categories) in a single pass, routing each
+    row to its file as it streams.  Rows with a DATA_ISSUE_TYPE that isn't in inventory_categories are written to
+    {bad_data_subdir}inventory_unrecognized_data_issue_type.csv and each unrecognized value is flagged in the summary.  
+    Param - initial_inventory_load: (view) The typed naviline inventory load  
+    Returns - None
+    '''
+    header = etl.header(initial_inventory_load)
+    issue_type_index = header.index('DATA_ISSUE_TYPE')
+
+    files = {}
+    writers = {}
+    row_counts = {}
+    for file_name in list(inventory_categories.values()) + [unrecognized_inventory_file]:
+        files[file_name] = open_export_file(file_name)
+        writers[file_name] = csv.writer(files[file_name])
+        writers[file_name].writerow(header)
+        row_counts[file_name] = 0
+    unrecognized_counts = {}
 
-    audit_meters = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'AUDIT_METER')
-    export_view_to_file(audit_meters, f"{bad_data_subdir}inventory_audit_meters")
+    try:
+        for row in etl.data(initial_inventory_load):
+            issue_type = row[issue_type_index]
+            file_name = inventory_categories.get(issue_type)
+            if file_name is None:
+                file_name = unrecognized_inventory_file
+                unrecognized_counts[issue_type] = unrecognized_counts.get(issue_type, 0) + 1
+            writers[file_name].writerow(row)
+            row_counts[file_name] += 1
+    finally:
+        for f in files.values():
+            f.close()
 
-    installed = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'CLEAN-ACTIVE/INSTALLED')
-    export_view_to_file(installed, f"{debug_data_subdir}inventory_installed_meters")
+    for file_name, row_count in row_counts.items():
+        stat_output(f"Number of rows in {file_name}: {row_count}")
+    for issue_type, row_count in unrecognized_counts.items():
+        stat_output(f"WARNING: unrecognized DATA_ISSUE_TYPE {issue_type!r} in inventory: {row_count} rows")
 
-    reusable = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'CLEAN-ACTIVE/USED_INVENTORY')
-    export_view_to_file(reusable, f"{debug_data_subdir}inventory_used_meters")
 
-    trashed = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'CLEAN-PURGED/SCRAPPED_INVENTORY')
-    export_view_to_file(trashed, f"{debug_data_subdir}inventory_discarded_meters")
-
-    new_meters = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'CLEAN-ACTIVE/NEW_INVENTORY')
-    export_view_to_file(new_meters, f"{debug_data_subdir}inventory_new_meters")
-    
-    unknown = etl.select(initial_inventory_load, lambda rec: rec['DATA_ISSUE_TYPE'] == 'UNKNOWN')
-    export_view_to_file(unknown, f"{debug_data_subdir}inventory_uncategorized")
 
 
+def build_key_index(rows, key_indexes):
+    '''
+    Builds an in-memory hash index over rows, keyed by the values at key_indexes.  
+    Param - rows: (list) The data rows (no header) to index  
+    Param - key_indexes: (int[]) The positions of the key fields in each row  
+    Return - A dict of key tuple -> list of rows with that key
+    '''
+    index = {}
+    for row in rows:
+        index.setdefault(tuple(row[i] for i in key_indexes), []).append(row)
+    return index
 
 
 def join_naviline_and_sensus(init_nav, clean_nav, sensus_view):
@@ -578,32 +1625,146 @@ def join_naviline_and_sensus(init_nav, clean_nav, sensus_view):
     {bad_data_subdir}/records_in_Naviline_with_no_match_in_DM_records.csv  
     {bad_data_subdir}/records_in_DM_with_no_match_in_Naviline.csv  
 
+    All six come from hash indexes on the Sensus keys built once, with each naviline and sensus row classified in
+    a single pass, instead of six sort based petl joins.  The output has the same fields as the petl joins would
+    (left fields, then right fields without the join keys), but rows are in source order rather than key order.
+
     Param - init_nav: (view) The view containing the initial load of naviline data, before being cleaned
     Param - naviline_view: (view) The view containing cleaned joinable naviline data  
     Param - sensus_view: (view) The view containing sensus data to join  
     Return - Two new views (view) with naviline data left joined (With init load) and regular joined (With clean load) to sensus data
     '''
-    in_both = etl.join(clean_nav,sensus_view,lkey=['REGISTER','RADIO'],rkey=['SensusMeterNumber','SensusRadioId'])
+    nav_header = tuple(etl.header(clean_nav))
+    init_nav_header = tuple(etl.header(init_nav))
+    sensus_header = tuple(etl.header(sensus_view))
+    sensus_rows = list(iter(etl.data(sensus_view)))
+
+    nav_register = nav_header.index('REGISTER')
+    nav_radio = nav_header.index('RADIO')
+    init_nav_register = init_nav_header.index('REGISTER')
+    init_nav_radio = init_nav_header.index('RADIO')
+    sensus_meter = sensus_header.index('SensusMeterNumber')
+    sensus_radio = sensus_header.index('SensusRadioId')
+
+    # Sensus fields carried into each output (the join keys are dropped, like petl does)
+    keep_for_both = [i for i in range(len(sensus_header)) if i not in (sensus_meter, sensus_radio)]
+    keep_for_meter = [i for i in range(len(sensus_header)) if i != sensus_meter]
+    keep_for_radio = [i for i in range(len(sensus_header)) if i != sensus_radio]
+
+    sensus_by_both = build_key_index(sensus_rows, [sensus_meter, sensus_radio])
+    sensus_by_meter = build_key_index(sensus_rows, [sensus_meter])
+    sensus_by_radio = build_key_index(sensus_rows, [sensus_radio])
+
+    in_both = [nav_header + tuple(sensus_header[i] for i in keep_for_both)]
+    wrong_radio_in_nv = [nav_header + tuple(sensus_header[i] for i in keep_for_meter)]
+    wrong_register_in_nv = [nav_header + tuple(sensus_header[i] for i in keep_for_radio)]
+    not_in_dm = [nav_header]
+    nav_registers = set()
+    nav_radios = set()
+
+    for row in etl.data(clean_nav):
+        row = tuple(row)
+        register = row[nav_register]
+        radio = row[nav_radio]
+        nav_registers.add(register)
+        nav_radios.add(radio)
+
+        for match in sensus_by_both.get((register, radio), []):
+            in_both.append(row + tuple(match[i] for i in keep_for_both))
+
+        # Validation Checks: mismatched RADIO or REGISTER
+        meter_matches = sensus_by_meter.get((register,), [])
+        for match in meter_matches:
+            if radio != match[sensus_radio]:
+                wrong_radio_in_nv.append(row + tuple(match[i] for i in keep_for_meter))
+
+        radio_matches = sensus_by_radio.get((radio,), [])
+        for match in radio_matches:
+            if register != match[sensus_meter]:
+                wrong_register_in_nv.append(row + tuple(match[i] for i in keep_for_radio))
+
+        # Identify unmatched records between sources
+        if not meter_matches and not radio_matches:
+            not_in_dm.append(row)
+
+    not_in_nv = [sensus_header]
+    for row in sensus_rows:
+        if row[sensus_radio] not in nav_radios and row[sensus_meter] not in nav_registers:
+            not_in_nv.append(row)
+
+    no_match = tuple(None for i in keep_for_both)
+    left_join_nav_sensus = [init_nav_header + tuple(sensus_header[i] for i in keep_for_both)]
+    for row in etl.data(init_nav):
+        row = tuple(row)
+        matches = sensus_by_both.get((row[init_nav_register], row[init_nav_radio]))
+        if matches:
+            for match in matches:
+                left_join_nav_sensus.append(row + tuple(match[i] for i in keep_for_both))
+        else:
+            left_join_nav_sensus.append(row + no_match)
+
+    in_both = etl.wrap(in_both)
     export_view_to_file(in_both, f"{debug_data_subdir}cleanly_joined_records_between_Naviline_and_DM")
 
-    left_join_nav_sensus = etl.leftjoin(init_nav,sensus_view,lkey=['REGISTER','RADIO'],rkey=['SensusMeterNumber','SensusRadioId'])
+    left_join_nav_sensus = etl.wrap(left_join_nav_sensus)
     export_view_to_file(left_join_nav_sensus, f"{debug_data_subdir}left_joined_records_between_Naviline_and_DM")
 
-    # Validation Checks: mismatched RADIO or REGISTER
-    wrong_radio_in_nv = etl.select(etl.join(clean_nav,sensus_view,lkey='REGISTER',rkey='SensusMeterNumber'), lambda rec: rec.RADIO != rec.SensusRadioId)
-    export_view_to_file(wrong_radio_in_nv, f"{bad_data_subdir}records_with_wrong_radio_in_Naviline")
-
-    wrong_register_in_nv = etl.select(etl.join(clean_nav,sensus_view,lkey='RADIO',rkey='SensusRadioId'), lambda rec: rec.REGISTER != rec.SensusMeterNumber)
-    export_view_to_file(wrong_register_in_nv, f"{bad_data_subdir}records_with_wrong_register_in_Naviline")
+    export_view_to_file(etl.wrap(wrong_radio_in_nv), f"{bad_data_subdir}records_with_wrong_radio_in_Naviline")
+    export_view_to_file(etl.wrap(wrong_register_in_nv), f"{bad_data_subdir}records_with_wrong_register_in_Naviline")
+    export_view_to_file(etl.wrap(not_in_dm), f"{bad_data_subdir}records_in_Naviline_with_no_match_in_DM_records")
+    export_view_to_file(etl.wrap(not_in_nv), f"{bad_data_subdir}records_in_DM_with_no_match_in_Naviline")
 
-    # Identify unmatched records (anti-joins) between sources
-    not_in_dm = etl.antijoin(etl.antijoin(clean_nav,sensus_view,lkey='RADIO',rkey='SensusRadioId'),sensus_view,lkey='REGISTER',rkey='SensusMeterNumber')
-    export_view_to_file(not_in_dm, f"{bad_data_subdir}records_in_Naviline_with_no_match_in_DM_records")
+    return left_join_nav_sensus, in_both
 
-    not_in_nv = etl.antijoin(etl.antijoin(sensus_view,clean_nav,lkey='SensusRadioId',rkey='RADIO'),clean_nav,lkey='SensusMeterNumber',rkey='REGISTER')
-    export_view_to_file(not_in_nv, f"{bad_data_subdir}records_in_DM_with_no_match_in_Naviline")
 
-    return left_join_nav_sensus, in_both
+def get_naviline_delta(initial_nv_load):
+    '''
+    Compares today's naviline load with the initial_naviline_load of the most recent earlier run whose Esri edits
+    all went in (the one with an edits applied marker), by NAVILINE_SERVICE_ID.  Runs made with --noupdate, runs
+    that stopped before their edits finished and runs whose edits errored are passed over, so their changes are
+    still in the delta.  Creates three .csv files:  
+    {debug_data_subdir}/naviline_delta_inserted.csv  
+    {debug_data_subdir}/naviline_delta_changed.csv  
+    {debug_data_subdir}/naviline_delta_deleted.csv (rows from the earlier run)  
+    Param - initial_nv_load: (view) The typed naviline load for this run  
+    Return - A set of inserted or changed service ids and a set of deleted service ids, or None, None if there is
+    no earlier load to compare with (or its fields are different)
+    '''
+    latest_file = find_previous_workdir_file(os.path.basename(input_nv))
+    previous_file = find_previous_workdir_file(os.path.basename(input_nv), edits_applied_marker_name)
+    if previous_file is None:
+        if latest_file is None:
+            stat_output("Naviline delta: no earlier naviline load found, using the full load")
+        else:
+            stat_output("Naviline delta: no earlier run applied all of its Esri edits, using the full load")
+        return None, None
+    if previous_file != latest_file:
+        stat_output(f"Naviline delta: passing over {latest_file}, its Esri edits didn't all go in")
+    previous_nv_load = read_columnar_snapshot(previous_file)
+    if previous_nv_load is None:
+        previous_nv_load = materialize(convert_naviline_to_proper_types(CountedSourceView(etl.fromcsv(previous_file, errors='ignore'), "Previous naviline load"), "Previous naviline load"))
+    if tuple(etl.header(previous_nv_load)) != tuple(etl.header(initial_nv_load)):
+        stat_output(f"Naviline delta: fields in {previous_file} don't match today's, using the full load")
+        return None, None
+
+    def rows_by_service_id(view):
+        service_id_index = etl.header(view).index('NAVILINE_SERVICE_ID')
+        rows = {}
+        for row in etl.data(view):
+            rows.setdefault(row[service_id_index], set()).add(tuple(row))
+        return rows
+
+    previous_rows = rows_by_service_id(previous_nv_load)
+    current_rows = rows_by_service_id(initial_nv_load)
+    inserted = set(current_rows) - set(previous_rows)
+    changed = set(service_id for service_id in current_rows if service_id in previous_rows and current_rows[service_id] != previous_rows[service_id])
+    deleted = set(previous_rows) - set(current_rows)
+
+    stat_output(f"Naviline delta against {previous_file}")
+    export_view_to_file(etl.select(initial_nv_load, lambda rec: rec.NAVILINE_SERVICE_ID in inserted), f"{debug_data_subdir}naviline_delta_inserted")
+    export_view_to_file(etl.select(initial_nv_load, lambda rec: rec.NAVILINE_SERVICE_ID in changed), f"{debug_data_subdir}naviline_delta_changed")
+    export_view_to_file(etl.select(previous_nv_load, lambda rec: rec.NAVILINE_SERVICE_ID in deleted), f"{debug_data_subdir}naviline_delta_deleted")
+    return inserted | changed, deleted
 
 
 def get_esri_adds(in_both_nav_sensus, esri_initial_data):
@@ -613,7 +1774,7 @@ def get_esri_adds(in_both_nav_sensus, esri_initial_data):
     Param - esri_initial_data: (view) View containing all data from Esri.  
     Return - A new view (view) containing rows ready to be added
     '''
-    not_in_esri = etl.antijoin(in_both_nav_sensus,esri_initial_data,lkey='NAVILINE_SERVICE_ID',rkey='Esri_Naviline_Service_Id')
+    not_in_esri = materialize(etl.antijoin(in_both_nav_sensus,esri_initial_data,lkey='NAVILINE_SERVICE_ID',rkey='Esri_Naviline_Service_Id'))
     export_view_to_file(not_in_esri, f"{debug_data_subdir}records_in_Naviline_with_no_match_in_Esri_records")
 
     # 16. Prepare new records to add to ESRI (status = 0)  Make sure they have coordinates
@@ -716,7 +1877,7 @@ def get_esri_updates(left_join_nav_sensus, esri_joinable_data):
     Param - esri_joinable_data: (view) View containing cleaned data from Esri.  
     Return - A new view (view) containing rows ready to be updated
     '''
-    matches_with_esri = etl.join(left_join_nav_sensus,esri_joinable_data,lkey='NAVILINE_SERVICE_ID',rkey='Esri_Naviline_Service_Id')
+    matches_with_esri = materialize(etl.join(left_join_nav_sensus,esri_joinable_data,lkey='NAVILINE_SERVICE_ID',rkey='Esri_Naviline_Service_Id'))
     export_view_to_file(matches_with_esri, f"{debug_data_subdir}records_in_Naviline_that_match_records_in_Esri")
 
     # anything in matches_with_esri that is currently status 2, needs to be changed to status 0.  Otherwise leave the status alone.  This 
@@ -727,7 +1888,7 @@ def get_esri_updates(left_join_nav_sensus, esri_joinable_data):
     # Records requiring update in ESRI: compare all fields
     matches_that_require_update = etl.select(etl.addfield(matches_with_esri_status,"Whats_Diff", whats_diff), lambda rec: rec.Whats_Diff != None)
 
-    matches_that_require_update = etl.unpack(etl.convert(etl.addfields(matches_that_require_update,[("NEW_XY",'')]),'NEW_XY', need_new_coordinates, pass_row=True),'NEW_XY',['X_to_update','Y_to_update'])
+    matches_that_require_update = materialize(etl.unpack(etl.convert(etl.addfields(matches_that_require_update,[("NEW_XY",'')]),'NEW_XY', need_new_coordinates, pass_row=True),'NEW_XY',['X_to_update','Y_to_update']))
     # Records requiring update in ESRI: missing locations
     #esri_with_missing_location = etl.select(esri_joinable_data, lambda rec: rec.Esri_X == None or rec.Esri_Y == None or rec.Esri_X == 0 or rec.Esri_Y == 0)
     #export_view_to_file(esri_with_missing_location, f"{bad_data_subdir}missing_location_in_esri_data")
@@ -758,7 +1919,8 @@ def get_esri_updates(left_join_nav_sensus, esri_joinable_data):
                                         'Esri_OBJECTID',
                                         'New_Status',
                                         'X_to_update',
-                                        'Y_to_update'),{
+                                        'Y_to_update',
+                                        'Whats_Diff'),{
                                                 'NAVILINE_SERVICE_ID':'Naviline_Service_Id',
                                                 'METERNUMBER':'Meter_Number',
                                                 'LOCATIONID':'Location_Id',
@@ -793,7 +1955,7 @@ def get_esri_removes(left_join_nav_sensus, esri_joinable_data):
     Param - esri_joinable_data: (view) View containing cleaned data from Esri.  
     Return - A new view (view) containing rows ready to be removed
     '''
-    not_in_naviline = etl.antijoin(esri_joinable_data,left_join_nav_sensus,lkey='Esri_Naviline_Service_Id',rkey='NAVILINE_SERVICE_ID')
+    not_in_naviline = materialize(etl.antijoin(esri_joinable_data,left_join_nav_sensus,lkey='Esri_Naviline_Service_Id',rkey='NAVILINE_SERVICE_ID'))
     export_view_to_file(not_in_naviline, f"{debug_data_subdir}records_in_Esri_with_no_match_in_Naviline")
 
     # 15. Identify removals for ESRI (status != 2, add status = 2)
@@ -805,11 +1967,18 @@ def get_esri_removes(left_join_nav_sensus, esri_joinable_data):
 # --- ADD ---
 def insert_rows(esri_adds):
     """
-    This function takes in a petl dataview and inserts each row into the remote ESRI dataset.  
+    This function takes in a petl dataview and inserts its rows into the remote ESRI dataset in chunks of
+    ESRI_INSERT_CHUNK_SIZE, one applyEdits call per chunk.  A chunk the server reports as failed is redone row by
+    row with an InsertCursor.  If the call fails without an answer (ex. a timeout) the chunk may still have been
+    added, so only the rows whose services aren't on the layer are redone.  Set ESRI_INSERT_WITH_APPLY_EDITS = false to always use the InsertCursor.  Services already added
+    according to the edit journal are skipped.  A chunk added by applyEdits is journaled once it's in, rows added
+    by the InsertCursor are journaled one at a time.  
     Param - esri_updates: (view) A PETL dataview containing rows to insert  
     Returns: None
     """
-    rows_to_insert = list(etl.dicts(esri_adds))
+    rows_to_insert = [row for row in iter(etl.dicts(esri_adds)) if ('add', row["Naviline_Service_Id"]) not in journaled_edits]
+    if len(rows_to_insert) < etl.nrows(esri_adds):
+        stat_output(f"Number of adds skipped, already applied: {etl.nrows(esri_adds) - len(rows_to_insert)}")
     # print("ROWS TO INSERT: " + str(rows_to_insert))
 
     # Convert list of dictionaries into a list of lists, with the list elements in the correct order for inserting into arcGIS.
@@ -843,97 +2012,380 @@ def insert_rows(esri_adds):
 
     # print("ADDING ROWS: " + str(row_list))
 
+    chunk_size = config.getint('Misc', 'ESRI_INSERT_CHUNK_SIZE', fallback=500)
+    use_apply_edits = config.getboolean('Misc', 'ESRI_INSERT_WITH_APPLY_EDITS', fallback=True)
+    chunk_count = (len(row_list) + chunk_size - 1) // chunk_size
+    for i in range(0, len(row_list), chunk_size):
+        chunk = row_list[i:i+chunk_size]
+        chunk_number = i // chunk_size + 1
+        start = time.perf_counter()
+        method = "applyEdits"
+        if use_apply_edits:
+            chunk_service_ids = [row[esri_meter_fields.index('Naviline_Service_Id')] for row in chunk]
+            try:
+                apply_edits_adds(chunk)
+            except ApplyEditsRejected as e:
+                # The server answered, and rollbackOnFailure means nothing from the chunk was added, so redo it row by row
+                print(f"applyEdits failed for insert chunk {chunk_number}, falling back to InsertCursor: {e}")
+                method = "InsertCursor fallback"
+                insert_rows_with_cursor(chunk)
+            except Exception as e:
+                # No answer, the server may have added the chunk anyway.  Check the layer before redoing any of it.
+                print(f"applyEdits didn't answer for insert chunk {chunk_number}, checking the layer for its services: {e}")
+                added = service_ids_in_layer(chunk_service_ids)
+                journal_edits('add', [service_id for service_id in chunk_service_ids if service_id in added])
+                missing = [row for row, service_id in zip(chunk, chunk_service_ids) if service_id not in added]
+                method = f"{len(chunk) - len(missing)} found on the layer, {len(missing)} by InsertCursor fallback"
+                insert_rows_with_cursor(missing)
+            else:
+                journal_edits('add', chunk_service_ids)
+        else:
+            method = "InsertCursor"
+            insert_rows_with_cursor(chunk)
+        stat_output(f"Insert chunk {chunk_number} of {chunk_count}: {len(chunk)} rows in {time.perf_counter() - start:.1f} seconds ({method})")
+
+def insert_rows_with_cursor(row_list):
+    """
+    Inserts rows one at a time with an arcpy InsertCursor, journaling each one as it goes in, so a failure partway
+    through doesn't leave rows that a resumed run would add again.  
+    Param - row_list: (list) Rows in esri_meter_fields order  
+    Returns: None
+    """
+    service_id_index = esri_meter_fields.index('Naviline_Service_Id')
     # TODO: I couldn't get Append to work, this way is a little slower.
     with arcpy.da.InsertCursor(meters_feature_server, esri_meter_fields) as iCur:
         for row in row_list:
             iCur.insertRow(row)
+            journal_edits('add', [row[service_id_index]])
 
     # arcpy.management.Append(row_list, meters_feature_server, "NO_TEST")
 
-
-# --- UPDATE ---
-def update_rows(esri_updates):
+def service_ids_in_layer(service_ids):
     """
-    This function takes in a petl dataview, breaks it into batches, and pushes each row to the
-    remote ESRI dataset.  
-    Param - esri_updates: (view) A PETL dataview containing rows to update  
-    Returns: None
+    Looks up which Naviline service ids have a row on the meters layer, in batches that keep the where clause under
+    ESRI_MAX_WHERE_LENGTH characters.  
+    Param - service_ids: (list) The service ids to look for  
+    Returns - A set of the ones found
     """
-    rows_to_update = list(etl.dicts(esri_updates))
-    #print("--- Rows to update: " + str(update_rows))
-
-    #update_ids = [row["Naviline_Service_Id"] for row in rows_to_update]
-    #print("--- Meter IDs: " + str(update_ids))
-
-
-    for i in range(0, len(rows_to_update), esri_batch_size):
-        batch = rows_to_update[i:i+esri_batch_size]
-
-        nav_dict = {row["Naviline_Service_Id"]: row for row in batch}
-
-        print(f"--- Updating batch {i//esri_batch_size + 1} of {len(rows_to_update) // esri_batch_size + 1}")
-
-        sql_query = "Naviline_Service_Id IN ({})".format(", ".join(["'{}'".format(key) for key in nav_dict.keys()]))
-        with arcpy.da.UpdateCursor(meters_feature_server, esri_meter_fields, sql_query) as uCur:
-            for esri_row in uCur:
-                nav_row = nav_dict.get(esri_row[1])
-                if nav_row:
-                    esri_row[2] = nav_row["Meter_Number"]
-                    esri_row[3] = nav_row["Location_Id"]
-                    esri_row[4] = nav_row["Cycle"]
-                    esri_row[5] = nav_row["Sequence"]
-                    esri_row[6] = nav_row["Location_On_Property"]
-                    esri_row[7] = nav_row["Jurisdiction"]
-                    esri_row[8] = nav_row["ServiceType"]
-                    esri_row[9] = nav_row["Meter_Size"]
-                    esri_row[10] = nav_row["Rate_Class"]
-                    esri_row[11] = nav_row["Address"]
-                    esri_row[12] = nav_row["Install_Date"]
-                    esri_row[13] = nav_row["Meter_Make"]
-                    esri_row[14] = nav_row["Customer_Name"]
-                    esri_row[15] = nav_row["Register"]
-                    esri_row[16] = nav_row["Radio_Id"]
-                    esri_row[21] = nav_row["Status"]
-                    if nav_row["X"] != None and nav_row["Y"] != None and nav_row["X"] != 0 and nav_row["Y"] != 0:
-                        esri_row[22] = arcpy.Point(nav_row["X"], nav_row["Y"])
-                    try:
-                        #print("UPDATING ROW: " + str(esri_row))
-                        uCur.updateRow(esri_row)
-                    except Exception as e:
-                        print("Error updating row: " + str(esri_row))
-                        print("Error message: " + e)
-
-
-# --- REMOVE ---
-def remove_rows(esri_removes):
-    """
-    This function acts much like the update_rows function, but it only updates the status field to 2, or "Removed".
-    It does not actually remove rows from ESRI.  
-    Param - esri_removes: (view) Dataview that contains rows to mark as removed.  
-    Returns - None
+    max_where_length = config.getint('Misc', 'ESRI_MAX_WHERE_LENGTH', fallback=4000)
+    batches = [[]]
+    where_length = 0
+    for service_id in service_ids:
+        quoted = "'" + str(service_id).replace("'", "''") + "'"
+        if batches[-1] and where_length + len(quoted) + 2 > max_where_length:
+            batches.append([])
+            where_length = 0
+        batches[-1].append(quoted)
+        where_length += len(quoted) + 2
+
+    found = set()
+    for batch in batches:
+        if batch:
+            where_clause = "Naviline_Service_Id IN ({})".format(", ".join(batch))
+            with arcpy.da.SearchCursor(meters_feature_server, ['Naviline_Service_Id'], where_clause) as sCur:
+                for row in sCur:
+                    found.add(row[0])
+    return found
+
+def to_esri_json_value(value):
     """
-    rows_to_remove = list(etl.dicts(esri_removes))
+    Converts a value for the Esri REST api.  Dates go as epoch milliseconds; naive datetimes are treated as UTC.
+    """
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple()) * 1000
+    return value
 
-    for i in range(0, len(rows_to_remove), esri_batch_size):
-        batch = rows_to_remove[i:i+esri_batch_size]
+class ApplyEditsRejected(Exception):
+    """
+    The feature server answered an applyEdits request with an error or a failed edit.  With rollbackOnFailure
+    nothing in that request was applied, unlike a request that failed without an answer.
+    """
 
-        nav_dict = {row["Naviline_Service_Id"]: row for row in batch}
+def apply_edits(edits):
+    """
+    Sends one applyEdits request to the meters feature server, signed with the token from the arcpy portal sign in.
+    rollbackOnFailure is set, so either every edit in the request is applied or none are.  
+    Param - edits: (dict) applyEdits parameters, ex. {'adds': [...]}.  Values are json encoded here  
+    Returns - The decoded json response.  Raises ApplyEditsRejected if the response says the edits failed, or the
+    requests exception if there was no usable response
+    """
+    signin_token = arcpy.GetSigninToken()
+    data = {key: json.dumps(value) for key, value in edits.items()}
+    data.update({'f': 'json', 'rollbackOnFailure': 'true', 'token': signin_token['token']})
+    headers = {'Referer': signin_token['referer']} if signin_token.get('referer') else {}
+
+    response = requests.post(f"{meters_feature_server}/applyEdits", data=data, headers=headers, timeout=300)
+    response.raise_for_status()
+    result = response.json()
+    if 'error' in result:
+        raise ApplyEditsRejected(f"applyEdits error: {result['error']}")
+    for results_key in ['addResults', 'updateResults', 'deleteResults']:
+        failures = [edit_result for edit_result in result.get(results_key, []) if not edit_result.get('success')]
+        if failures:
+            raise ApplyEditsRejected(f"applyEdits {results_key} failures: {failures[:5]}")
+    return result
+
+def apply_edits_adds(row_list):
+    """
+    Adds rows to the meters feature server with a single applyEdits call.  
+    Param - row_list: (list) Rows in esri_meter_fields order, as built by insert_rows  
+    Returns: None
+    """
+    features = []
+    for row in row_list:
+        attributes = {}
+        for field_name, value in zip(esri_meter_fields, row):
+            if field_name != 'Shape' and value is not None:
+                attributes[field_name] = to_esri_json_value(value)
+        shape = row[esri_meter_fields.index('Shape')]
+        features.append({'attributes': attributes, 'geometry': {'x': shape.X, 'y': shape.Y}})
+    apply_edits({'adds': features})
+
+
+# --- BATCHING ---
+def object_id_where_clause(object_ids):
+    return "OBJECTID IN ({})".format(", ".join(str(object_id) for object_id in object_ids))
+
+def run_esri_batches(keys, build_where_clause, apply_batch, label):
+    """
+    Splits keys into batches and runs apply_batch on each, ESRI_EDIT_WORKERS batches at a time.  The first batch is
+    esri_batch_size keys; after that the size is scaled from the observed round trip so a batch takes about
+    ESRI_TARGET_BATCH_SECONDS (never more than doubling or halving at once, and never over ESRI_MAX_BATCH_SIZE).
+    A batch is also cut short if its where clause would be longer than ESRI_MAX_WHERE_LENGTH characters.
+    The time and error count of every batch go to stat_output.  
+    Param - keys: (list) The keys to edit, in order  
+    Param - build_where_clause: (function) Takes a list of keys, returns the where clause that selects them  
+    Param - apply_batch: (function) Takes a list of keys and its where clause, edits them, returns the number of rows that errored  
+    Param - label: (string) Name of the edit for the output, ex. Update  
+    Returns - The total number of rows that errored
+    """
+    workers = config.getint('Misc', 'ESRI_EDIT_WORKERS', fallback=4)
+    target_seconds = config.getfloat('Misc', 'ESRI_TARGET_BATCH_SECONDS', fallback=5.0)
+    max_batch_size = config.getint('Misc', 'ESRI_MAX_BATCH_SIZE', fallback=1000)
+    max_where_length = config.getint('Misc', 'ESRI_MAX_WHERE_LENGTH', fallback=4000)
 
-        print(f"--- Removing batch {i//esri_batch_size + 1} of {len(rows_to_remove) // esri_batch_size + 1}")
+    def timed_batch(batch_keys, where_clause):
+        start = time.perf_counter()
+        try:
+            errors = apply_batch(batch_keys, where_clause)
+        except Exception as e:
+            stat_output(f"Error in {label} batch: {e}")
+            errors = len(batch_keys)
+        return time.perf_counter() - start, errors
+
+    batch_size = esri_batch_size
+    position = 0
+    batch_number = 0
+    total_errors = 0
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as batch_pool:
+        while position < len(keys) or in_flight:
+            # Keep every worker busy with the current batch size
+            while position < len(keys) and len(in_flight) < workers:
+                batch_keys = keys[position:position+batch_size]
+                where_clause = build_where_clause(batch_keys)
+                while len(where_clause) > max_where_length and len(batch_keys) > 1:
+                    batch_keys = batch_keys[:len(batch_keys) // 2]
+                    where_clause = build_where_clause(batch_keys)
+                position += len(batch_keys)
+                batch_number += 1
+                in_flight[batch_pool.submit(timed_batch, batch_keys, where_clause)] = (batch_number, len(batch_keys))
+
+            done, not_done = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished_batch, finished_size = in_flight.pop(future)
+                seconds, errors = future.result()
+                total_errors += errors
+                stat_output(f"{label} batch {finished_batch}: {finished_size} rows in {seconds:.1f} seconds, {errors} errors")
+                if seconds > 0:
+                    scale = min(2.0, max(0.5, target_seconds / seconds))
+                    batch_size = max(1, min(max_batch_size, int(finished_size * scale)))
+
+    stat_output(f"{label}: {len(keys)} rows in {batch_number} batches, {total_errors} errors")
+    return total_errors
 
-        sql_query = "Naviline_Service_Id IN ({})".format(", ".join(["'{}'".format(key) for key in nav_dict.keys()]))
-        with arcpy.da.UpdateCursor(meters_feature_server, esri_meter_fields, sql_query) as uCur:
-            for esri_row in uCur:
-                nav_row = nav_dict.get(esri_row[1])
-                if nav_row:
-                    esri_row[21] = nav_row["Status"]
+# --- UPDATE ---
+def esri_fields_to_update(nav_row):
+    """
+    Works out which layer fields an update needs to write, from the Whats_Diff that get_esri_updates put on the row.
+    The Esri_ prefix is dropped to get the layer field name, and Missing_Esri_Coordinates becomes the Shape field.  
+    Param - nav_row: (dict) A row from the prepped updates  
+    Returns - A tuple of layer field names, sorted, with 'Shape' last when the coordinates need to be filled in
+    """
+    update_fields = []
+    update_geometry = False
+    for diff in nav_row["Whats_Diff"].split(","):
+        if diff == "Missing_Esri_Coordinates":
+            update_geometry = True
+        else:
+            update_fields.append(diff[len("Esri_"):])
+    update_fields.sort()
+    if update_geometry:
+        update_fields.append("Shape")
+    return tuple(update_fields)
+
+# --- PLAN AND APPLY EDITS ---
+def plan_esri_edits(esri_updates, esri_removes):
+    """
+    Combines the prepped updates and removes into one set of edits keyed by OBJECTID.  An update carries only the
+    fields in its Whats_Diff (see esri_fields_to_update); a remove is just Status = 2.  An OBJECTID with more than
+    one different edit is left out of the plan and its edits are written to
+    {bad_data_subdir}conflicting_esri_edits.csv.  
+    Param - esri_updates: (view) The prepped updates from get_esri_updates  
+    Param - esri_removes: (view) The prepped removes from get_esri_removes  
+    Returns - A dict of OBJECTID -> dict of layer field name -> new value, where Shape holds an (X, Y) tuple
+    """
+    edits_by_id = {}
+    for row in etl.dicts(esri_updates):
+        edit = {}
+        for field_name in esri_fields_to_update(row):
+            edit[field_name] = (row["X"], row["Y"]) if field_name == "Shape" else row[field_name]
+        edits_by_id.setdefault(row["OBJECTID"], []).append(("update", row["Naviline_Service_Id"], edit))
+    for row in etl.dicts(esri_removes):
+        edits_by_id.setdefault(row["OBJECTID"], []).append(("remove", row["Naviline_Service_Id"], {"Status": row["Status"]}))
+
+    edit_plan = {}
+    conflicts = [("OBJECTID", "Edit_Type", "Naviline_Service_Id", "Edit")]
+    for object_id in sorted(edits_by_id):
+        edits = edits_by_id[object_id]
+        if all(edit == edits[0][2] for edit_type, service_id, edit in edits):
+            edit_plan[object_id] = edits[0][2]
+        else:
+            for edit_type, service_id, edit in edits:
+                conflicts.append((object_id, edit_type, service_id, edit))
+
+    export_view_to_file(etl.wrap(conflicts), f"{bad_data_subdir}conflicting_esri_edits")
+    stat_output(f"Number of edits planned for Esri: {len(edit_plan)}")
+    return edit_plan
+
+def apply_esri_edits(edit_plan):
+    """
+    Applies an edit plan from plan_esri_edits in one batched pass over the layer.  Edits that change the same set
+    of fields share an UpdateCursor carrying only those fields, selected by OBJECTID and batched by run_esri_batches.
+    OBJECTIDs already edited according to the edit journal are skipped.  Each batch journals the rows it updated,
+    leaving out any whose updateRow failed so a resumed run tries them again.  
+    Param - edit_plan: (dict) OBJECTID -> dict of layer field name -> new value  
+    Returns - The number of rows that errored
+    """
+    edit_groups = {}
+    skipped = 0
+    for object_id, edit in edit_plan.items():
+        if ('edit', object_id) in journaled_edits:
+            skipped += 1
+            continue
+        edit_fields = tuple(sorted(field_name for field_name in edit if field_name != "Shape"))
+        if "Shape" in edit:
+            edit_fields += ("Shape",)
+        edit_groups.setdefault(edit_fields, []).append(object_id)
+    if skipped:
+        stat_output(f"Number of edits skipped, already applied: {skipped}")
+
+    total_errors = 0
+    for edit_fields, object_ids in edit_groups.items():
+        cursor_fields = ["OBJECTID"] + list(edit_fields)
+        print(f"--- Editing {len(object_ids)} rows changing {', '.join(edit_fields)}")
+
+        label = f"Edit {', '.join(edit_fields)}"
+
+        def edit_batch(batch_ids, sql_query):
+            errors = 0
+            updated_ids = []
+            try:
+                with arcpy.da.UpdateCursor(meters_feature_server, cursor_fields, sql_query) as uCur:
+                    for esri_row in uCur:
+                        edit = edit_plan.get(esri_row[0])
+                        if edit:
+                            for position, field_name in enumerate(edit_fields, start=1):
+                                if field_name == "Shape":
+                                    esri_row[position] = arcpy.Point(*edit["Shape"])
+                                else:
+                                    esri_row[position] = edit[field_name]
+                            try:
+                                #print("UPDATING ROW: " + str(esri_row))
+                                uCur.updateRow(esri_row)
+                                updated_ids.append(esri_row[0])
+                            except Exception as e:
+                                errors += 1
+                                # stat_output, so lines from the other batch threads don't run into it
+                                stat_output(f"Error updating row in {label}: {esri_row}. Error message: {e}")
+            finally:
+                # Also on a cursor failure, so the rows that did go in aren't redone on resume
+                journal_edits('edit', updated_ids)
+            return errors
+
+        total_errors += run_esri_batches(object_ids, object_id_where_clause, edit_batch, label)
+    return total_errors
+
+# --- CHECKPOINTS ---
+def checkpoint_dir():
+    return os.path.join(workdir, 'checkpoints')
+
+def save_checkpoint(stage, outputs):
+    """
+    Pickles the outputs of a stage to {workdir}/checkpoints/{stage}.pickle.  Tables are stored as their rows.  The
+    file is written under a temporary name first, so a run that dies mid-write leaves the previous checkpoint.  
+    Param - stage: (string) The name of the stage, one of pipeline_stages  
+    Param - outputs: (list) The values the next stage needs
+    """
+    os.makedirs(checkpoint_dir(), exist_ok=True)
+    stored = [(True, list(iter(value))) if isinstance(value, Table) else (False, value) for value in outputs]
+    checkpoint_path = os.path.join(checkpoint_dir(), f'{stage}.pickle')
+    with open(checkpoint_path + '.tmp', 'wb') as f:
+        pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+def load_checkpoint(stage):
+    """
+    Loads the outputs saved by save_checkpoint.  Exits if the stage has no checkpoint in the workdir.  
+    Param - stage: (string) The name of the stage  
+    Returns - The list of outputs, with tables rewrapped as PETL tables
+    """
+    checkpoint_path = os.path.join(checkpoint_dir(), f'{stage}.pickle')
+    if not os.path.exists(checkpoint_path):
+        print(f"Missing checkpoint {checkpoint_path}. Resume from an earlier stage or specify a --folder with the checkpoint.")
+        exit()
+    with open(checkpoint_path, 'rb') as f:
+        stored = pickle.load(f)
+    return [etl.wrap(value) if is_table else value for is_table, value in stored]
 
-                    # print("REMOVING ROW: " + str(esri_row))
-                    try:
-                        uCur.updateRow(esri_row)
-                    except Exception as e:
-                        print("Error updating row: " + str(esri_row))
-                        print("Error message: " + e)
+def open_edit_journal(resume):
+    """
+    Opens {workdir}/checkpoints/edit_journal.txt, which gets a line for every add chunk and edit batch once it has
+    been applied to Esri.  When resuming, the pairs already in it are loaded into journaled_edits so they are
+    skipped; otherwise the journal is started over.  
+    Param - resume: (bool) Whether this run is resuming an earlier one
+    """
+    global edit_journal
+    os.makedirs(checkpoint_dir(), exist_ok=True)
+    journal_path = os.path.join(checkpoint_dir(), 'edit_journal.txt')
+    journaled_edits.clear()
+    if resume and os.path.exists(journal_path):
+        with open(journal_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    kind, key = json.loads(line)
+                    journaled_edits.add((kind, key))
+        stat_output(f"Number of edits already applied according to the edit journal: {len(journaled_edits)}")
+    edit_journal = open(journal_path, 'a' if resume else 'w')
+
+def journal_edits(kind, keys):
+    """
+    Records edits as applied.  Safe to call from the Esri batch threads.  
+    Param - kind: (string) 'add' (keyed by Naviline service id) or 'edit' (keyed by OBJECTID)  
+    Param - keys: (list) The keys that were applied
+    """
+    if edit_journal is None:
+        return
+    with journal_lock:
+        for key in keys:
+            edit_journal.write(json.dumps([kind, key]) + "\n")
+        edit_journal.flush()
+
+def close_edit_journal():
+    global edit_journal
+    if edit_journal is not None:
+        edit_journal.close()
+        edit_journal = None
 
 def rmtree(top):
     """
@@ -984,16 +2436,8 @@ def cleanup_keep_latest(base_path, keep=10):
         rmtree(folder_path)
 
 def main():
-    #declare globals
-    global workdir
-    global input_nv
-    global input_nv_inventory
-    global input_dm
-    global input_esri
-    global summary_file
     global transformer
-
-
+    global output_base
 
     # Coordinate System
     transformer = Transformer.from_crs("EPSG:4326", "EPSG:2264")  # WGS84 to NC State Plane (2264)
@@ -1002,18 +2446,105 @@ def main():
     parser.add_argument("-d","--dont_fetch", help="don't fetch data from remotes",action='store_true')
     parser.add_argument("-f","--folder", help="use this folder as the work folder instead of the one based on todays date")
     parser.add_argument("-n","--noupdate",help="Don't update Esri",action='store_true')
+    parser.add_argument("-t","--export_threads",help="write csv exports on a pool of this many threads",type=int,default=1)
+    parser.add_argument("-D","--delta",help="only send services inserted, changed or deleted in Naviline since the last run whose Esri edits all went in",action='store_true')
+    parser.add_argument("-b","--benchmark_extractors",help="time each Naviline extractor on both queries, then exit",action='store_true')
+    parser.add_argument("-B","--benchmark_sensus",help="time both Sensus readers on a synthetic file of this many rows, then exit",type=int)
+    parser.add_argument("-p","--profile",help="profile the run with cProfile, writing profile.pstats and profile.txt to the work folder",action='store_true')
+    parser.add_argument("-r","--resume_from","--resume-from",help="pick up the run in the work folder at this stage, using the checkpoint of the stage before it",choices=pipeline_stages)
+    parser.add_argument("-s","--service","--daemon",help="keep running, with a reconciliation cycle every DAEMON_INTERVAL_MINUTES or when DAEMON_TRIGGER_FILE appears",action='store_true')
     args = parser.parse_args()
 
-    # Define working directory and file paths
     # workdir is set based on the following prioirity: command line (-f), config file (Misc->OUTPUT_DIR), default (./output/)
     output_base = 'output/'
     if ('OUTPUT_DIR' in config['Misc'] and config['Misc']['OUTPUT_DIR']):
         output_base = config['Misc']['OUTPUT_DIR']
+
+    if (args.service):
+        run_service(args)
+    else:
+        run_integration(args)
+
+    close_naviline_connections()
+    if jpype is not None and jpype.isJVMStarted():
+        jpype.shutdownJVM()
+
+def run_service(args):
+    """
+    Runs reconciliation cycles until stopped with Ctrl+C, keeping the JVM, the pooled Naviline connections and the
+    portal session alive between them.  A cycle starts every DAEMON_INTERVAL_MINUTES minutes, or as soon as
+    DAEMON_TRIGGER_FILE appears (the file is removed when its cycle starts).  A cycle that fails is reported and its
+    connections are dropped, so the next cycle reconnects.  --resume_from only applies to the first cycle.  
+    Param - args: (Namespace) The parsed command line
+    """
+    global export_pool
+    global esri_signed_in
+    interval_seconds = config.getfloat('Misc', 'DAEMON_INTERVAL_MINUTES', fallback=240) * 60
+    trigger_file = config.get('Misc', 'DAEMON_TRIGGER_FILE', fallback='')
+    poll_seconds = config.getfloat('Misc', 'DAEMON_POLL_SECONDS', fallback=10)
+
+    cycle = 0
+    try:
+        while True:
+            cycle += 1
+            next_cycle = time.monotonic() + interval_seconds
+            print(f"Starting cycle {cycle} at {datetime.now():%Y-%m-%d %H:%M:%S}")
+            try:
+                run_integration(args, cycle)
+            except (Exception, SystemExit) as e:     # the pipeline exit()s on fatal errors
+                print(f"Cycle {cycle} failed, reconnecting for the next one: {e!r}")
+                close_naviline_connections()
+                esri_signed_in = False
+                close_edit_journal()
+                if (export_pool is not None):
+                    export_pool.shutdown()
+                    export_pool = None
+                pending_exports.clear()
+                if summary_file is not None and not summary_file.closed:
+                    summary_file.close()
+            args.resume_from = None
+
+            while time.monotonic() < next_cycle:
+                if trigger_file and os.path.exists(trigger_file):
+                    os.remove(trigger_file)
+                    print(f"Found {trigger_file}, starting the next cycle now")
+                    break
+                time.sleep(max(0, min(poll_seconds, next_cycle - time.monotonic())))
+    except KeyboardInterrupt:
+        print(f"Stopping after {cycle} cycles")
+
+def run_integration(args, cycle=None):
+    """
+    Runs the integration once: the stages from fetch (or --resume_from) to apply_edits, in the work folder.  
+    Param - args: (Namespace) The parsed command line  
+    Param - cycle: (int) The cycle number when running as a service, None for a single run
+    """
+    #declare globals
+    global workdir
+    global input_nv
+    global input_nv_inventory
+    global input_dm
+    global input_esri
+    global summary_file
+    global export_pool
+
+    # Counts and timings are per run
+    source_passes.clear()
+    conversion_failures.clear()
+    stage_timings.clear()
+    pending_exports.clear()
+
+    # Define working directory and file paths
     workdir = output_base + '/' + date.today().strftime("%Y%m%d") + '/'
     if (args.folder):
         workdir = args.folder
 
     os.makedirs(workdir, exist_ok=True)
+    write_stage_timings()   # start stage_timings.json over, it is rewritten as each stage finishes
+    profiler = None
+    if (args.profile):
+        profiler = cProfile.Profile()
+        profiler.enable()
     #input files
     input_nv = workdir + 'initial_naviline_load.csv'
     input_nv_inventory = workdir + 'initial_naviline_inventory_load.csv'
@@ -1022,65 +2553,138 @@ def main():
 
     #summary output files
     summary_file_path = workdir + 'summary.txt'
-    summary_file = open(summary_file_path, "w")
+    summary_file = open(summary_file_path, "a" if args.resume_from or cycle else "w")
+    if (cycle is None or cycle == 1):
+        stat_output(f"Startup time: {time.perf_counter() - startup_start:.2f} seconds")
+    if (cycle is not None):
+        stat_output(f"Service cycle {cycle} started at {datetime.now():%Y-%m-%d %H:%M:%S}")
+
+    resume_stage = pipeline_stages.index(args.resume_from) if args.resume_from else 0
+    if (args.resume_from):
+        stat_output(f"Resuming from stage {args.resume_from}")
+    elif (os.path.exists(checkpoint_dir())):
+        rmtree(checkpoint_dir())    # checkpoints from an earlier run in this folder would not match this one
+
+    if (args.export_threads > 1):
+        export_pool = ThreadPoolExecutor(max_workers=args.export_threads)
+
+    if (args.benchmark_extractors):
+        benchmark_naviline_extractors()
+        summary_file.close()
+        return
+
+    if (args.benchmark_sensus):
+        benchmark_sensus_readers(args.benchmark_sensus)
+        summary_file.close()
+        return
     
+    # Written again only if this run's edits all go in
+    if (os.path.exists(edits_applied_marker())):
+        os.remove(edits_applied_marker())
+
     initial_nv_load = None
     initial_dm_load = None
     initial_esri_load = None
+    fetching = not(args.dont_fetch) and resume_stage == 0
 
     #Only connect to esri if updating or fetching; don't connect only if not updating AND not fetching
-    if(not(args.noupdate) or not(args.dont_fetch)):
-        esri_connection_setup()
-
-
-    if (args.dont_fetch):
-        if (not(os.path.exists(input_nv)) or not(os.path.exists(input_dm)) or not(os.path.exists(input_esri))):
-            print("Missing Input Files. Please fetch data by removing the --dont_fetch flag or specifying a --folder with the data.")
-            exit()
-        initial_nv_load = load_naviline_data_from_file()
-        initial_nv_inventory_load = load_naviline_inventory_from_file()
-        initial_dm_load = load_sensus_data()
-        initial_esri_load = load_esri_data_from_file()
-    else:
-        navline_connection_setup()
-        initial_nv_load = load_naviline_data()
-        initial_nv_inventory_load = load_naviline_inventory()
-        transfer_sensus_data()
-        initial_dm_load = load_sensus_data()
-        initial_esri_load = load_esri_data()
+    if(not(args.noupdate) or fetching):
+        ensure_esri_connection()
+
+    # Stages fetch and convert: fetching writes the raw csvs (the fetch checkpoint) and converts them as they load
+    if (resume_stage <= pipeline_stages.index('convert')):
+        if (not(fetching)):
+            if (not(os.path.exists(input_nv)) or not(os.path.exists(input_dm)) or not(os.path.exists(input_esri))):
+                print("Missing Input Files. Please fetch data by removing the --dont_fetch flag or specifying a --folder with the data.")
+                exit()
+            initial_nv_load = run_timed('naviline_load', load_naviline_data_from_file)
+            initial_nv_inventory_load = run_timed('naviline_inventory_load', load_naviline_inventory_from_file)
+            initial_dm_load = run_timed('sensus_load', load_sensus_data)
+            initial_esri_load = run_timed('esri_load', load_esri_data_from_file)
+        else:
+            initial_nv_load, initial_nv_inventory_load, initial_dm_load, initial_esri_load = run_timed('fetch', fetch_all_sources)
+        save_checkpoint('convert', [initial_nv_load, initial_nv_inventory_load, initial_dm_load, initial_esri_load])
     
     
 
-    naviline_joinable_data = clean_naviline_data(initial_nv_load)
-    sensus_joinable_data = clean_sensus_data(initial_dm_load)
-    esri_joinable_data = clean_esri_data(initial_esri_load)
-    categorize_meter_inventory(initial_nv_inventory_load)
-    # Special transformation to ensure there are no duplicate Naviline_Service_Ids.
-    initial_nv_load = etl.distinct(initial_nv_load, "NAVILINE_SERVICE_ID")
-
-    left_join_nav_sensus, in_both_nav_sensus = join_naviline_and_sensus(initial_nv_load, naviline_joinable_data, sensus_joinable_data)
+    # Stage clean
+    if (resume_stage <= pipeline_stages.index('clean')):
+        if (resume_stage > pipeline_stages.index('convert')):
+            initial_nv_load, initial_nv_inventory_load, initial_dm_load, initial_esri_load = load_checkpoint('convert')
+        naviline_joinable_data = run_timed('clean_naviline', clean_naviline_data, initial_nv_load)
+        sensus_joinable_data = run_timed('clean_sensus', clean_sensus_data, initial_dm_load)
+        esri_joinable_data = run_timed('clean_esri', clean_esri_data, initial_esri_load)
+        run_timed('categorize_inventory', categorize_meter_inventory, initial_nv_inventory_load)
+        delta_service_ids, deleted_service_ids = None, None
+        if (args.delta):
+            delta_service_ids, deleted_service_ids = run_timed('naviline_delta', get_naviline_delta, initial_nv_load)
+        # Special transformation to ensure there are no duplicate Naviline_Service_Ids.
+        with stage_timer('distinct_naviline', etl.nrows(initial_nv_load)) as timing:
+            initial_nv_load = materialize(etl.distinct(initial_nv_load, "NAVILINE_SERVICE_ID"))
+            timing['rows_out'] = etl.nrows(initial_nv_load)
+        save_checkpoint('clean', [initial_nv_load, initial_esri_load, naviline_joinable_data, sensus_joinable_data, esri_joinable_data, delta_service_ids, deleted_service_ids])
+
+    # Stage reconcile
+    if (resume_stage <= pipeline_stages.index('reconcile')):
+        if (resume_stage > pipeline_stages.index('clean')):
+            initial_nv_load, initial_esri_load, naviline_joinable_data, sensus_joinable_data, esri_joinable_data, delta_service_ids, deleted_service_ids = load_checkpoint('clean')
+        left_join_nav_sensus, in_both_nav_sensus = run_timed('join', join_naviline_and_sensus, initial_nv_load, naviline_joinable_data, sensus_joinable_data)
+
+        esri_removable_data = esri_joinable_data
+        if (delta_service_ids is not None):
+            with stage_timer('delta_filter', count_rows((left_join_nav_sensus, in_both_nav_sensus, esri_joinable_data))) as timing:
+                # Only the services that changed go on to the Esri diff, and only services deleted from Naviline can be removed
+                left_join_nav_sensus = materialize(etl.select(left_join_nav_sensus, lambda rec: rec.NAVILINE_SERVICE_ID in delta_service_ids))
+                in_both_nav_sensus = materialize(etl.select(in_both_nav_sensus, lambda rec: rec.NAVILINE_SERVICE_ID in delta_service_ids))
+                esri_removable_data = materialize(etl.select(esri_joinable_data, lambda rec: rec.Esri_Naviline_Service_Id in deleted_service_ids))
+                timing['rows_out'] = count_rows((left_join_nav_sensus, in_both_nav_sensus, esri_removable_data))
+
+        esri_updates = run_timed('diff_updates', get_esri_updates, left_join_nav_sensus, esri_joinable_data)
+        esri_adds = run_timed('diff_adds', get_esri_adds, in_both_nav_sensus, initial_esri_load)
+        esri_removes = run_timed('diff_removes', get_esri_removes, left_join_nav_sensus, esri_removable_data)
+        save_checkpoint('reconcile', [esri_updates, esri_adds, esri_removes])
+
+    # Stage plan_edits
+    if (resume_stage <= pipeline_stages.index('plan_edits')):
+        if (resume_stage > pipeline_stages.index('reconcile')):
+            esri_updates, esri_adds, esri_removes = load_checkpoint('reconcile')
+        edit_plan = run_timed('plan_edits', plan_esri_edits, esri_updates, esri_removes)
+        save_checkpoint('plan_edits', [esri_adds, edit_plan])
+    else:
+        esri_adds, edit_plan = load_checkpoint('plan_edits')
 
-    esri_updates = get_esri_updates(left_join_nav_sensus, esri_joinable_data)
-    esri_adds = get_esri_adds(in_both_nav_sensus, initial_esri_load)
-    esri_removes = get_esri_removes(left_join_nav_sensus, esri_joinable_data)
+    run_timed('export', wait_for_exports)
+    if (export_pool is not None):
+        export_pool.shutdown()
+        export_pool = None
+    report_source_passes()
+    report_conversion_failures()
 
-    # Finalize
-    summary_file.close()
     # ---------------------------------------------------------------------------------
-    # Insert into ESRI
+    # Stage apply_edits: Insert into ESRI
 
     if (not(args.noupdate)):
         print("UPDATING ESRI")
-        insert_rows(esri_adds)
-        update_rows(esri_updates)
-        remove_rows(esri_removes)
+        open_edit_journal(args.resume_from is not None)
+        with stage_timer('insert', etl.nrows(esri_adds)):
+            insert_rows(esri_adds)
+        with stage_timer('update_remove', len(edit_plan)):
+            edit_errors = apply_esri_edits(edit_plan)
+        close_edit_journal()
+        if (edit_errors == 0):
+            write_edits_applied_marker(etl.nrows(esri_adds), len(edit_plan))
+        else:
+            stat_output(f"Esri edits with errors: {edit_errors}, a later --delta run won't use this run as its baseline")
     else:
         print("cowardly refusing to update esri")
-    
-    if (not(args.dont_fetch)):
-        nav_conn.close()
-        if jpype.isJVMStarted():
-            jpype.shutdownJVM()
+
+    # Finalize, after the Esri edits so their chunk and batch timings make it into the summary
+    if (profiler is not None):
+        profiler.disable()
+        profiler.dump_stats(workdir + 'profile.pstats')
+        with open(workdir + 'profile.txt', "w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(50)
+    summary_file.close()
 
     cleanup_keep_latest(output_base,30)
 if __name__ == "__main__":